@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import settings
+import utilities
+from items import ImageDatabase
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+LIBRARY_FOLDER = 'library'
+SOURCE_FILE = 'source.png'
+
+
+def generate_library(folder, count, size, seed):
+    """
+    write count synthetic jpg images to folder, each a random gradient with noise so average colors spread
+    over the whole color space and a fair part of the images collide
+    :return: None
+    """
+    random = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    ramp = np.linspace(-1, 1, size)[None, :, None]
+    progress = metrics.Progress(count)
+    for index in range(count):
+        base = random.randint(0, 256, 3)
+        slope = random.randint(-64, 65, 3)
+        noise = random.randint(-16, 17, (size, size, 3))
+        pixels = np.clip(base + ramp * slope + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, '{:06d}.jpg'.format(index)), quality=90)
+        progress.update(index + 1)
+
+
+def generate_source(filename, width, height, seed):
+    """
+    write a synthetic source image with smooth regions and edges, like a picture
+    :return: None
+    """
+    random = np.random.RandomState(seed + 1)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    pixels = np.zeros((height, width, 3))
+    for channel in range(3):
+        fx, fy, phase = random.uniform(1, 8, 3)
+        pixels[..., channel] = 128 + 127 * np.sin(fx * x * np.pi + phase) * np.cos(fy * y * np.pi)
+    pixels[(x - 0.5) ** 2 + (y - 0.3) ** 2 < 0.04] = random.randint(0, 256, 3)
+    Image.fromarray(pixels.astype(np.uint8)).save(filename)
+
+
+class Stage(object):
+    """
+    time and peak memory of one benchmarked stage
+
+    Variables:
+        self.name
+        self.items  # number of tiles or chunks processed
+        self.unit  # what self.items counts, for the throughput
+        self.seconds
+        self.peak_memory  # bytes, peak allocated by python and numpy in this process during the stage
+    """
+
+    def __init__(self, name, items, unit):
+        self.name = name
+        self.items = items
+        self.unit = unit
+        self.seconds = None
+        self.peak_memory = None
+        self._start = None
+        self._base_memory = None
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self._base_memory = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        self.peak_memory = tracemalloc.get_traced_memory()[1] - self._base_memory
+        return False
+
+    @property
+    def rate(self):
+        return self.items / self.seconds if self.seconds else float('inf')
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'items': self.items,
+            'unit': self.unit,
+            'rate': self.rate,
+            'peak_memory': self.peak_memory,
+        }
+
+
+def run_once(args):
+    """
+    build, load, match with each method and composite once, in the current directory
+    :return: list of Stage
+    """
+    stages = []
+    database_folder = utilities.get_database_structure(LIBRARY_FOLDER).folder
+    if os.path.isdir(database_folder):
+        shutil.rmtree(database_folder)
+
+    with Stage('build', args.images, 'tiles') as stage:
+        database = ImageDatabase(args.size, args.size, LIBRARY_FOLDER)
+        database.process_and_save_files()
+    stages.append(stage)
+    del database
+
+    with Stage('load', args.images, 'tiles') as stage:
+        database = ImageDatabase.load(LIBRARY_FOLDER, args.size, args.size)
+    stages.append(stage)
+
+    with Stage('process', args.images, 'tiles') as stage:
+        database.process_images()
+    stages.append(stage)
+
+    source = Image.open(SOURCE_FILE).convert('RGB')
+    width, height = source.size
+    grid = database.describe(source, args.size)
+    rows, cols = grid.shape[:2]
+    features = grid.reshape(rows * cols, -1)
+
+    indices = None
+    for method in args.methods:
+        # matchers are reset so lookup tables and trees are built within the stage they are used in
+        database.process_images()
+        with Stage('match {}'.format(method), len(features), 'chunks') as stage:
+            indices = database.find_closest_batch(features, args.repeat, method=method)
+        stages.append(stage)
+
+    with Stage('composite', len(features), 'chunks') as stage:
+        database.tile_cache = utilities.LRUCache(settings.TILE_CACHE_SIZE)
+        Image.fromarray(database.composite(indices, rows, cols)[:height, :width])
+    stages.append(stage)
+
+    return stages
+
+
+def best_of(runs):
+    """
+    :param runs: list of list of Stage, one list for each run
+    :return: list of Stage with the lowest time of each stage
+    """
+    return [min(stages, key=lambda stage: stage.seconds) for stages in zip(*runs)]
+
+
+def describe(args):
+    return {
+        'config': {
+            'images': args.images,
+            'image_size': args.image_size,
+            'source': [args.width, args.height],
+            'size': args.size,
+            'repeat': args.repeat,
+            'methods': args.methods,
+            'runs': args.runs,
+            'seed': args.seed,
+            'settings': {name: value for name, value in vars(settings).items()
+                         if name.isupper() and isinstance(value, (int, float, str, tuple, type(None)))},
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+    }
+
+
+def compare(results, baseline):
+    """
+    print each stage against the same stage in baseline, a ratio above 1 is faster than baseline
+    """
+    baseline_stages = {stage['name']: stage for stage in baseline['stages']}
+    if baseline['config'] != json.loads(json.dumps(results['config'])):
+        print('Warning: baseline was run with a different config, ratios may not be meaningful')
+    print('{:<24}{:>12}{:>12}{:>10}{:>14}'.format('stage', 'seconds', 'baseline', 'speedup', 'memory ratio'))
+    for stage in results['stages']:
+        other = baseline_stages.get(stage['name'])
+        if other is None:
+            print('{:<24}{:>12.3f}{:>12}'.format(stage['name'], stage['seconds'], '-'))
+            continue
+        speedup = other['seconds'] / stage['seconds'] if stage['seconds'] else float('inf')
+        memory_ratio = stage['peak_memory'] / other['peak_memory'] if other['peak_memory'] else float('inf')
+        print('{:<24}{:>12.3f}{:>12.3f}{:>9.2f}x{:>13.2f}x'.format(
+            stage['name'], stage['seconds'], other['seconds'], speedup, memory_ratio))
+
+
+def report(stages):
+    print('{:<24}{:>12}{:>18}{:>14}'.format('stage', 'seconds', 'throughput', 'peak memory'))
+    for stage in stages:
+        print('{:<24}{:>12.3f}{:>12.1f} {:<6}{:>11.1f}MB'.format(
+            stage.name, stage.seconds, stage.rate, stage.unit + '/s', stage.peak_memory / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark building, loading, matching and compositing')
+    parser.add_argument('-n', '--images', type=int, default=3000, help='number of images in the synthetic library')
+    parser.add_argument('-is', '--image-size', type=int, default=128, help='width and height of library images')
+    parser.add_argument('-W', '--width', type=int, default=480, help='width of the synthetic source')
+    parser.add_argument('-H', '--height', type=int, default=320, help='height of the synthetic source')
+    parser.add_argument('-s', '--size', type=int, default=10, help='the size of each pieces')
+    parser.add_argument('-r', '--repeat', action='store_true', help='allow build with repeating images')
+    parser.add_argument('-m', '--methods', nargs='+', default=list(ImageDatabase.methods),
+                        help='color difference methods to benchmark, default all')
+    parser.add_argument('--runs', type=int, default=1, help='run everything this many times, keep the best time')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('-w', '--workdir', help='folder for the synthetic data, reused if present, default temporary')
+    parser.add_argument('-o', '--output', help='save results as json to this file')
+    parser.add_argument('-bl', '--baseline', help='json results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='save results as the baseline instead')
+    args = parser.parse_args()
+
+    for method in args.methods:
+        if method not in ImageDatabase.methods:
+            raise ValueError('Unknown color difference method: {}'.format(method))
+    if not args.repeat and (args.width // args.size) * (args.height // args.size) > args.images:
+        raise ValueError('Synthetic library is not enough to build without repeat, use --repeat or more --images')
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if len(os.listdir(LIBRARY_FOLDER) if os.path.isdir(LIBRARY_FOLDER) else []) != args.images:
+            print('Generating {} images in {} ...'.format(args.images, workdir))
+            start_time = time.time()
+            if os.path.isdir(LIBRARY_FOLDER):
+                shutil.rmtree(LIBRARY_FOLDER)
+            generate_library(LIBRARY_FOLDER, args.images, args.image_size, args.seed)
+            utilities.print_done(time.time() - start_time)
+        generate_source(SOURCE_FILE, args.width, args.height, args.seed)
+
+        tracemalloc.start()
+        runs = []
+        for run in range(args.runs):
+            print('=' * 50)
+            print('run {} / {}'.format(run + 1, args.runs))
+            print('=' * 50)
+            runs.append(run_once(args))
+        tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    stages = best_of(runs)
+    results = describe(args)
+    results['stages'] = [stage.to_dict() for stage in stages]
+
+    print('=' * 50)
+    report(stages)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Results saved to {}'.format(output))
+    if baseline and args.save_baseline:
+        with open(baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Baseline saved to {}'.format(baseline))
+    elif baseline:
+        with open(baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
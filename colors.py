@@ -0,0 +1,123 @@
+import numpy as np
+
+# D65 reference white
+REF_X = 95.047
+REF_Y = 100.000
+REF_Z = 108.883
+
+
+def rgb_to_xyz(rgb):
+    """
+    convert sRGB colors to CIE XYZ
+    :param rgb: (..., 3) array of 0-255 values
+    :return: (..., 3) array of XYZ values
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    x = r * 0.4124 + g * 0.3576 + b * 0.1805
+    y = r * 0.2126 + g * 0.7152 + b * 0.0722
+    z = r * 0.0193 + g * 0.1192 + b * 0.9505
+    return np.stack([x, y, z], axis=-1)
+
+
+def xyz_to_lab(xyz):
+    """
+    convert CIE XYZ colors to CIE L*a*b*
+    :param xyz: (..., 3) array of XYZ values
+    :return: (..., 3) array of Lab values
+    """
+    xyz = np.asarray(xyz, dtype=np.float64) / np.array([REF_X, REF_Y, REF_Z])
+    xyz = np.where(xyz > 0.008856, np.cbrt(xyz), (7.787 * xyz) + (16 / 116))
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    return np.stack([(116 * y) - 16, 500 * (x - y), 200 * (y - z)], axis=-1)
+
+
+def rgb_to_lab(rgb):
+    return xyz_to_lab(rgb_to_xyz(rgb))
+
+
+color_spaces = {
+    'rgb': lambda rgb: np.asarray(rgb, dtype=np.float64),
+    'lab': rgb_to_lab,
+}
+
+
+# color differences, https://en.wikipedia.org/wiki/Color_difference
+# each takes (B, 3) reference Lab colors and (N, 3) sample Lab colors, returns (B, N) differences
+
+def _split(lab1, lab2):
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    return (lab1[:, 0, None], lab1[:, 1, None], lab1[:, 2, None],
+            lab2[None, :, 0], lab2[None, :, 1], lab2[None, :, 2])
+
+
+def cie76(lab1, lab2):
+    l1, a1, b1, l2, a2, b2 = _split(lab1, lab2)
+    return np.sqrt((l1 - l2) ** 2 + (a1 - a2) ** 2 + (b1 - b2) ** 2)
+
+
+def cie94(lab1, lab2, k_l=1, k_1=0.045, k_2=0.015):
+    l1, a1, b1, l2, a2, b2 = _split(lab1, lab2)
+    c1 = np.hypot(a1, b1)
+    c2 = np.hypot(a2, b2)
+    d_c = c1 - c2
+    d_h2 = np.maximum((a1 - a2) ** 2 + (b1 - b2) ** 2 - d_c ** 2, 0)
+    s_c = 1 + k_1 * c1
+    s_h = 1 + k_2 * c1
+    return np.sqrt(((l1 - l2) / k_l) ** 2 + (d_c / s_c) ** 2 + d_h2 / (s_h ** 2))
+
+
+def ciede2000(lab1, lab2):
+    l1, a1, b1, l2, a2, b2 = _split(lab1, lab2)
+    c_avg = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    g = 0.5 * (1 - np.sqrt(c_avg ** 7 / (c_avg ** 7 + 25 ** 7)))
+    a1p = (1 + g) * a1
+    a2p = (1 + g) * a2
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+    no_hue = (c1p * c2p) == 0
+
+    d_lp = l2 - l1
+    d_cp = c2p - c1p
+    d_hp = h2p - h1p
+    d_hp = np.where(d_hp > 180, d_hp - 360, np.where(d_hp < -180, d_hp + 360, d_hp))
+    d_hp = np.where(no_hue, 0, d_hp)
+    d_big_hp = 2 * np.sqrt(c1p * c2p) * np.sin(np.radians(d_hp / 2))
+
+    lp_avg = (l1 + l2) / 2
+    cp_avg = (c1p + c2p) / 2
+    hp_sum = h1p + h2p
+    hp_avg = np.where(np.abs(h1p - h2p) > 180, np.where(hp_sum < 360, hp_sum + 360, hp_sum - 360), hp_sum) / 2
+    hp_avg = np.where(no_hue, hp_sum, hp_avg)
+
+    t = (1 - 0.17 * np.cos(np.radians(hp_avg - 30)) + 0.24 * np.cos(np.radians(2 * hp_avg))
+         + 0.32 * np.cos(np.radians(3 * hp_avg + 6)) - 0.20 * np.cos(np.radians(4 * hp_avg - 63)))
+    d_ro = 30 * np.exp(-(((hp_avg - 275) / 25) ** 2))
+    r_c = 2 * np.sqrt(cp_avg ** 7 / (cp_avg ** 7 + 25 ** 7))
+    s_l = 1 + (0.015 * (lp_avg - 50) ** 2) / np.sqrt(20 + (lp_avg - 50) ** 2)
+    s_c = 1 + 0.045 * cp_avg
+    s_h = 1 + 0.015 * cp_avg * t
+    r_t = -np.sin(np.radians(2 * d_ro)) * r_c
+    return np.sqrt((d_lp / s_l) ** 2 + (d_cp / s_c) ** 2 + (d_big_hp / s_h) ** 2
+                   + r_t * (d_cp / s_c) * (d_big_hp / s_h))
+
+
+def cmc(lab1, lab2, l=2, c=1):
+    l1, a1, b1, l2, a2, b2 = _split(lab1, lab2)
+    c1 = np.hypot(a1, b1)
+    c2 = np.hypot(a2, b2)
+    d_c = c1 - c2
+    d_h2 = np.maximum((a1 - a2) ** 2 + (b1 - b2) ** 2 - d_c ** 2, 0)
+    h1 = np.degrees(np.arctan2(b1, a1)) % 360
+    f = np.sqrt(c1 ** 4 / (c1 ** 4 + 1900))
+    t = np.where((164 <= h1) & (h1 <= 345),
+                 0.56 + np.abs(0.2 * np.cos(np.radians(h1 + 168))),
+                 0.36 + np.abs(0.4 * np.cos(np.radians(h1 + 35))))
+    s_l = np.where(l1 < 16, 0.511, 0.040975 * l1 / (1 + 0.01765 * l1))
+    s_c = 0.0638 * c1 / (1 + 0.0131 * c1) + 0.638
+    s_h = s_c * (f * t + 1 - f)
+    return np.sqrt(((l1 - l2) / (l * s_l)) ** 2 + (d_c / (c * s_c)) ** 2 + d_h2 / (s_h ** 2))
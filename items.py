@@ -1,3 +1,5 @@
+import copy
+import io
 import os
 from itertools import repeat
 
@@ -5,6 +7,9 @@ import settings
 import numpy as np
 import time
 import utilities
+import matching
+import metrics
+import colors
 import math
 from glob import glob
 from PIL import Image
@@ -35,17 +40,70 @@ class ImageItem(object):
 
         return r_avg, g_avg, b_avg
 
+    @staticmethod
+    def get_grid_avg(image, size):
+        """
+        average color of every size x size chunk of the image in one pass,
+        chunks at right and bottom edges are averaged over the pixels they actually cover
+        :return: (rows, cols, 3) int64 array
+        """
+        pixels = np.asarray(image.convert('RGB'), dtype=np.uint8)
+        height, width = pixels.shape[:2]
+        rows, cols = math.ceil(height / size), math.ceil(width / size)
+        padded = np.zeros((rows * size, cols * size, 3), dtype=np.uint8)
+        padded[:height, :width] = pixels
+        sums = padded.reshape(rows, size, cols, size, 3).sum(axis=(1, 3), dtype=np.int64)
+        row_heights = np.minimum(size, height - np.arange(rows) * size)
+        col_widths = np.minimum(size, width - np.arange(cols) * size)
+        counts = row_heights[:, None] * col_widths[None, :]
+        return sums // counts[:, :, None]
+
+    @staticmethod
+    def get_cell_avg(image, size, grid):
+        """
+        average colors of grid x grid cells of every size x size chunk of the image,
+        chunks at right and bottom edges are padded by repeating their last pixels
+        :return: (rows, cols, grid * grid * 3) float64 array, cells of each chunk in raster order
+        """
+        pixels = np.asarray(image.convert('RGB'), dtype=np.uint8)
+        height, width = pixels.shape[:2]
+        rows, cols = math.ceil(height / size), math.ceil(width / size)
+        padded = np.pad(pixels, ((0, rows * size - height), (0, cols * size - width), (0, 0)), mode='edge')
+        cells = np.asarray(Image.fromarray(padded).resize((cols * grid, rows * grid), Image.BOX), dtype=np.float64)
+        return cells.reshape(rows, grid, cols, grid, 3).transpose(0, 2, 1, 3, 4).reshape(rows, cols, -1)
+
 
 class DatabaseImageItem(object):
+    """
+    decodes images of the database, also the class of pickled chunks of old databases, see migrate_legacy_chunks
+
+    Variables:
+        self.filename  # of pickled items only
+        self.big_image  # of pickled items only
+    """
 
-    def __init__(self, filename):
-        self.filename = filename
-        self.big_image = Image.open(filename).resize((settings.DATABASE_IMAGE_WIDTH, settings.DATABASE_IMAGE_HEIGHT))
+    @staticmethod
+    def open(filename):
+        image = Image.open(filename)
+        # let jpeg decode directly at a reduced scale that is still at least the largest database size
+        size = max(settings.DATABASE_IMAGE_SIZES)
+        image.draft('RGB', (size, size))
+        return image
 
     @staticmethod
-    def save(image, structure):
-        filename = structure.get_image_filename(image.filename)
-        utilities.save(image, filename)
+    def decode_timed(filename, data=None):
+        """
+        used by worker processes and threads, decode and also measure time spent, as workers cannot record metrics
+        :param data: content of the file if already read
+        :return: list of (size, size, 3) uint8 arrays of the file, one for each of sorted DATABASE_IMAGE_SIZES,
+                 seconds decoding, seconds resizing
+        """
+        start_time = time.perf_counter()
+        image = DatabaseImageItem.open(filename if data is None else io.BytesIO(data))
+        image.load()
+        decoded_time = time.perf_counter()
+        tiles = [utilities.image_to_tile(image, size) for size in sorted(settings.DATABASE_IMAGE_SIZES)]
+        return tiles, decoded_time - start_time, time.perf_counter() - decoded_time
 
 
 class ImageDatabase(object):
@@ -55,26 +113,72 @@ class ImageDatabase(object):
     def __init__(self, width, height, folder):
         self.width = width
         self.height = height
-        self.images = None
+        self.tiles = None
+        self.tile_features = None
+        self.tile_lab = None
+        self.level_features = None
+        self.level_lab = None
+        self.filenames = None
         self.source_folder = folder
         self.files = glob(self.source_folder + '/*[jpg|png]')
         self.structure = utilities.get_database_structure(self.source_folder)
         self.database_folder = self.structure.folder
+        self.level = self.structure.get_level(max(width, height))
         self.color_space = None
-        self.rgb_image_dict = None
+        self.color_index = None
+        self.features = None
+        self.lab_features = None
+        self.streaming = False
+        self.tile_cache = utilities.LRUCache(settings.TILE_CACHE_SIZE)
+        self.matcher = None
+        self.kd_tree = None
+        self.thumbnails = None
+        self.pca = None
         print('Database {} {}'.format(width, height))
 
     def process_images(self):
-        print('Processing images ...', end='')
-        start_time = time.time()
-        if not self.images:
+        if self.tile_features is None:
             raise ValueError('Please call process_and_save_files first')
-        self.rgb_image_dict = dict()
-        for image in self.images:
-            self.rgb_image_dict[(image.avg_r, image.avg_g, image.avg_b)] = image.img
-        self.images = None
+        with metrics.stage('index', len(self.tile_features)):
+            self._process_images()
 
-        print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+    def _process_images(self):
+        print('Processing images ...', end='')
+        start_time = time.time()
+        tile_features = self.tile_features
+        if settings.MAX_CHUNKS_USE:
+            limit = settings.MAX_CHUNKS_USE * settings.MAX_CACHE_PROCESSED_IMAGES
+            if limit < len(tile_features):
+                print(' reached limit for max chunks use ...', end='')
+                tile_features = tile_features[:limit]
+        self.tile_cache = utilities.LRUCache(settings.TILE_CACHE_SIZE)
+        self.matcher = None
+        self.kd_tree = None
+        self.color_space = None
+        self.pca = None
+        if settings.DESCRIPTOR_GRID:
+            space = 'lab' if settings.DESCRIPTOR_LAB else 'rgb'
+            descriptors = self.structure.load_descriptors(self.level, settings.DESCRIPTOR_GRID, space)
+            descriptors = descriptors[:len(tile_features)]
+            self.pca = matching.PCA.fit(descriptors, settings.DESCRIPTOR_COMPONENTS)
+            tile_features = self.pca.transform(descriptors)
+
+        # scoring a batch of chunks against every image at once would go over budget, read features from disk instead
+        self.streaming = len(tile_features) * settings.MATCH_BATCH_SIZE * 8 * 4 > settings.MATCH_MEMORY_BUDGET
+        if self.streaming:
+            print(' streaming features from disk ...', end='')
+            self.features = tile_features
+            self.lab_features = self.tile_lab[:len(tile_features)]
+            self.color_index = None
+            print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+            return
+
+        # match against distinct colors only, tiles sharing a color are all kept in the index
+        self.color_index = matching.ColorIndex(tile_features)
+        self.features = self.color_index.colors if self.pca else self.color_index.colors.astype(np.int64)
+        self.lab_features = self.tile_lab[self.color_index.first_tiles(np.arange(len(self.features)))]
+
+        print(' [ done ] => {0:.2f}s | {1} colors'.format(time.time() - start_time, len(self.features)))
 
     def process_and_save_files(self):
         """
@@ -85,127 +189,427 @@ class ImageDatabase(object):
         start_time = time.time()
         self.structure.remove_existing_files()
         self.structure.make_folders()
-        self.images = []
-
-        total = len(self.files)
-        files_chunks = []
-        start = 0
-        while start < total - 1:
-            end = start + settings.MAX_CACHE_PROCESSED_IMAGES
-            files_chunks.append(self.files[start:end])
-            start = end
-
-        total_chunks = len(files_chunks)
-        for chunk_index, chunk in enumerate(files_chunks):
-            processed_images = []
-            total_files = len(chunk)
-            for file_index, file in enumerate(chunk):
-                database_item = DatabaseImageItem(file)
-                processed_images.append(database_item)
-                self.images.append(ImageItem(database_item, self.width, self.height))
-                utilities.print_progress(file_index + 1, total_files, curr_chunk=chunk_index + 1,
-                                         total_chunks=total_chunks)
-            utilities.save(processed_images, self.structure.get_list_name(chunk_index))
+        with metrics.stage('build', len(self.files)):
+            self._write_store([], self.files, dict())
         utilities.print_done(time.time() - start_time)
 
-    def generate_color_space(self):
-
-        if not self.rgb_image_dict:
-            raise ValueError('Please call process_images first')
-
-        total = len(self.rgb_image_dict)
-        print('Generating color space | {}'.format(total))
+    def refresh(self):
+        """
+        bring a loaded database up to date with self.files using its manifest,
+        only new or changed files are decoded and deleted files are dropped
+        :return: True if the database was changed
+        """
+        manifest = self.structure.load_manifest()
+        save_manifest = manifest is None
+        if manifest is None:
+            # database created before manifest existed, trust images with the same filename if allowed
+            manifest = dict()
+            if settings.ALLOW_USE_EXISING_IF_SEEM_SAME:
+                for row, file in enumerate(self.filenames.tolist()):
+                    if os.path.isfile(file):
+                        manifest[file] = utilities.file_signature(file) + (None, row)
+
+        kept = []
+        new_files = []
+        signatures = dict()
+        for file in self.files:
+            signature = utilities.file_signature(file)
+            entry = manifest.get(file)
+            if entry is not None and entry[:2] == signature:
+                kept.append((file, entry[3]))
+                signatures[file] = entry[:3]
+                continue
+            if entry is not None and entry[2] is not None:
+                file_hash = utilities.file_hash(file)
+                if file_hash == entry[2]:  # touched but same content
+                    kept.append((file, entry[3]))
+                    signatures[file] = signature + (file_hash,)
+                    continue
+            new_files.append(file)
+
+        # in the order of the tile store, so new tiles can be appended when none were removed
+        kept.sort(key=lambda item: item[1])
+        removed = len(set(manifest) - set(self.files))
+        if not new_files and len(kept) == len(manifest) == len(self.tile_features):
+            if save_manifest or signatures != {file: entry[:3] for file, entry in manifest.items()}:
+                self.structure.save_manifest({file: signatures[file] + (row,) for file, row in kept})
+            if self.structure.shared is not None:
+                self.structure.shared.touch(self.structure.shared.lookup(self.structure.load_hashes()))
+                self.structure.shared.save()
+            print('Database is up to date | {}'.format(len(kept)))
+            return False
+
+        print('Refreshing database | kept: {} new or changed: {} removed: {}'.format(
+            len(kept), len(new_files), removed))
         start_time = time.time()
-        color_space = [[[[] for _ in range(256)] for _ in range(256)] for _ in range(256)]  # 256 x 256 x 256 arrays
-        for index, item in enumerate(self.rgb_image_dict.items()):
-            r, g, b = item[0]
-            color_space[r][g][b].append(item[1])
-            utilities.print_progress(index + 1, total)
-        self.images = None
+        with metrics.stage('build', len(new_files)):
+            self._write_store(kept, new_files, signatures)
         utilities.print_done(time.time() - start_time)
-        start_time = time.time()
-        print('cleaning color space ...', end='')
-        self.color_space = utilities.remove_empty(color_space)
-        print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+        return True
 
-    def find_by_color_space(self, other, use_repeat):
-        if not self.color_space:
-            self.generate_color_space()
-        return self.find_closest_in_color_space(other, use_repeat)
+    def _write_store(self, kept, new_files, signatures):
+        """
+        write the tile store with kept and new files, replacing the existing one when done
+        :param kept: list of (filename, row in current tile store) to copy over without decoding
+        :param new_files: files to decode, appended after kept
+        :param signatures: filename -> (size, mtime, hash) of kept files
+        """
+        total = len(kept) + len(new_files)
+        rows = np.array([row for _, row in kept], dtype=np.int64)
+        levels = self.structure.levels
+        if self.structure.shared is not None:
+            hashes, tiles = self._write_shared_tiles(kept, new_files, signatures)
+        else:
+            tiles, temporary = self._write_tiles(rows, new_files)
+            hashes = None
+
+        features = dict()
+        for level, level_tiles in zip(levels, tiles):
+            level_features = np.empty((total, 3), dtype=np.int64)
+            if len(kept):
+                level_features[:len(kept)] = self.level_features[level][rows]
+            if hashes is None:
+                new_tiles = level_tiles[len(kept):]
+            else:
+                # a view, slicing CachedTiles would read all the new tiles into memory at once
+                new_tiles = utilities.CachedTiles(level_tiles.tiles, level_tiles.slots[len(kept):])
+            with metrics.stage('feature', len(new_files)):
+                level_features[len(kept):] = utilities.tile_features(new_tiles)
+            del new_tiles
+            features[level] = level_features
+        del tiles, level_tiles
+        self.tiles = None
+        self.thumbnails = None
+        if hashes is None and temporary:
+            for level in levels:
+                self.structure.commit_tiles(level)
+        self.structure.remove_color_spaces()
+        self.structure.remove_descriptors()
+
+        files = [file for file, _ in kept] + list(new_files)
+        for file in new_files:
+            if file not in signatures:
+                file_hash = utilities.file_hash(file) if settings.MANIFEST_HASH else None
+                signatures[file] = utilities.file_signature(file) + (file_hash,)
+        with metrics.stage('feature'):
+            lab = {level: colors.rgb_to_lab(level_features) for level, level_features in features.items()}
+        self.structure.save_features(features, lab, files, hashes)
+        self.structure.save_manifest({file: signatures[file] + (row,) for row, file in enumerate(files)})
+
+        self.tiles = self.structure.open_tiles(self.level)
+        self.level_features = features
+        self.level_lab = lab
+        self.tile_features = features[self.level]
+        self.tile_lab = lab[self.level]
+        self.filenames = np.array(files, dtype=str)
+
+    def _write_tiles(self, rows, new_files):
+        """
+        write tiles of kept rows and new files, see _write_store. When no tile was removed or moved,
+        new tiles are appended to the tile store in place, else a new store is written beside it
+        :return: (list of tiles arrays, one for each level, True if written beside the store, call commit_tiles then)
+        """
+        total = len(rows) + len(new_files)
+        levels = self.structure.levels
+        if len(rows) and self.tile_features is not None and np.array_equal(rows, np.arange(len(self.tile_features))):
+            tiles = [self.structure.extend_tiles(total, level) for level in levels]
+            if all(level_tiles is not None for level_tiles in tiles):
+                self._decode_into(tiles, new_files, np.arange(len(rows), total))
+                for level_tiles in tiles:
+                    level_tiles.flush()
+                return tiles, False
+            del tiles
+
+        tiles = [self.structure.create_tiles(total, level, temporary=True) for level in levels]
+        if len(rows):
+            for level, level_tiles in zip(levels, tiles):
+                old_tiles = self.structure.load_tiles(level)
+                for start in range(0, len(rows), settings.MAX_CACHE_PROCESSED_IMAGES):
+                    block = rows[start:start + settings.MAX_CACHE_PROCESSED_IMAGES]
+                    level_tiles[start:start + len(block)] = old_tiles[block]
+                del old_tiles
+        self._decode_into(tiles, new_files, np.arange(len(rows), total))
+        for level_tiles in tiles:
+            level_tiles.flush()
+        return tiles, True
+
+    def _write_shared_tiles(self, kept, new_files, signatures):
+        """
+        put tiles of new files into the shared tile cache, images already in it from any folder are not decoded,
+        see SHARED_TILE_CACHE
+        :return: (hashes of kept and new files, list of CachedTiles, one for each level)
+        """
+        cache = self.structure.shared
+        levels = self.structure.levels
+        old_hashes = self.structure.load_hashes() if kept else []
+        hashes = [old_hashes[row] for _, row in kept]
+        for file in new_files:
+            file_hash = utilities.file_hash(file)
+            signatures[file] = utilities.file_signature(file) + (file_hash,)
+            hashes.append(file_hash)
+
+        # kept images may have been evicted since, they are decoded again too
+        slots = cache.lookup(hashes)
+        missing = dict()  # hash -> file
+        for file, file_hash, slot in zip([file for file, _ in kept] + list(new_files), hashes, slots.tolist()):
+            if slot == -1 and file_hash not in missing:
+                missing[file_hash] = file
+        metrics.count('shared tiles reused', len(set(hashes)) - len(missing))
+        print(' shared tile cache | reused: {} decoding: {}'.format(len(set(hashes)) - len(missing), len(missing)))
+        if missing:
+            new_slots = cache.allocate(list(missing), np.unique(slots[slots != -1]))
+            tiles = [cache.open_tiles(level, writable=True) for level in levels]
+            self._decode_into(tiles, list(missing.values()), new_slots)
+            del tiles
+            slots = cache.lookup(hashes)
+        cache.touch(slots)
+        cache.save()
+        return hashes, [utilities.CachedTiles(cache.open_tiles(level), slots) for level in levels]
 
     @staticmethod
-    def euclidean_dist(c1, c2):
-        r1, g1, b1 = c1
-        r2, g2, b2 = c2
-        return (r1 - r2) ** 2 + (g1 - g2) ** 2 + (b1 - b2) ** 2
-
-    def find_by_euclidean_dist(self, other, use_repeat):
-        # https: // en.wikipedia.org / wiki / Color_difference
-        rgb = min(self.rgb_image_dict, key=lambda rgb: self.euclidean_dist(rgb, (other.avg_r, other.avg_g, other.avg_b)))
-        item = self.rgb_image_dict[rgb]
-        if not use_repeat:
-            del self.rgb_image_dict[rgb]
-        return item
+    def _decode_into(tiles, files, rows):
+        """
+        decode files into tiles[rows] of every level, using BUILD_WORKERS processes or threads, see BUILD_PIPELINE
+        :param tiles: list of tiles arrays, one for each of sorted DATABASE_IMAGE_SIZES
+        :param rows: (len(files),) row to write each file to
+        """
+        total = len(files)
+        chunk_size = settings.MAX_CACHE_PROCESSED_IMAGES
+        progress = metrics.Progress(total)
+
+        workers = settings.BUILD_WORKERS or os.cpu_count() or 1
+        pool = None
+        if settings.BUILD_PIPELINE == 'threads':
+            # readers keep the disk busy while decoders keep the cores busy, this thread only writes
+            decoded = utilities.ReadDecodePipeline(files, DatabaseImageItem.decode_timed, settings.READ_WORKERS,
+                                                   workers, settings.DECODE_QUEUE_SIZE)
+        elif workers > 1 and total > 1:
+            # results come back in order, written as they arrive so the parent only holds a few at a time
+            pool = Pool(workers)
+            chunksize = max(1, min(utilities.get_chunksize(total), total // (workers * 4)))
+            decoded = enumerate(pool.imap(DatabaseImageItem.decode_timed, files, chunksize=chunksize))
+        else:
+            decoded = enumerate(map(DatabaseImageItem.decode_timed, files))
+        try:
+            for written, (index, (levels, decode_time, resize_time)) in enumerate(decoded):
+                metrics.add('decode', decode_time, 1)
+                metrics.add('resize', resize_time, 1)
+                for level_tiles, tile in zip(tiles, levels):
+                    level_tiles[rows[index]] = tile
+                if (written + 1) % chunk_size == 0 or written + 1 == total:
+                    for level_tiles in tiles:
+                        level_tiles.flush()
+                progress.update(written + 1)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def get_tile(self, index):
+        """
+        :param index: tile id, as returned by the find methods
+        :return: image of the tile resized to width and height of this database
+        """
+        return Image.fromarray(self.get_tile_arrays([index])[0])
 
-    @staticmethod
-    def euclidean_optimized_dist(c1, c2):
-        r1, g1, b1 = c1
-        r2, g2, b2 = c2
-        r_avg = (r1 + r2) / 2
-        return (2 + (r_avg / 256)) * ((r1 - r2) ** 2) + 4 * ((g1 - g2) ** 2) + (2 + ((255 - r_avg) / 256)) * (
-                    (b1 - b2) ** 2)
-
-    def find_by_euclidean_optimized_dist(self, other, use_repeat):
-        # https: // en.wikipedia.org / wiki / Color_difference
-        rgb = min(self.rgb_image_dict, key=lambda rgb: self.euclidean_optimized_dist(rgb, (other.avg_r, other.avg_g, other.avg_b)))
-        item = self.rgb_image_dict[rgb]
-        if not use_repeat:
-            del self.rgb_image_dict[rgb]
-        return item
-
-    color_diff_methods = {
-        'color space': 'find_by_color_space',
-        'euclidean': 'find_by_euclidean_dist',
-        'euclidean optimized': 'find_by_euclidean_optimized_dist',
-        'cie76': 'find_by_cie76',
-        'cie94': 'find_by_cie94',
-        'ciede2000': 'find_by_ciede2000',
-        'cmc': 'find_by_cmc'
-    }
-
-    def find_closest(self, other, use_repeat, method='euclidean_optimized'):
-        if not self.rgb_image_dict:
+    def get_tile_arrays(self, indices):
+        """
+        pixels of the tiles used, tiles not in the tile cache are read from the tile store in one go
+        :param indices: tile ids, as returned by the find methods
+        :return: (len(indices), height, width, 3) uint8 array
+        """
+        indices = [int(index) for index in indices]
+        fetched = {index: self.tile_cache.get(index) for index in set(indices)}
+        missing = sorted(index for index, tile in fetched.items() if tile is None)
+        metrics.count('tile cache hits', len(fetched) - len(missing))
+        metrics.count('tile cache misses', len(missing))
+        if missing:
+            tiles = np.asarray(self.tiles[missing])
+            for index, tile in zip(missing, tiles):
+                if tile.shape[:2] != (self.height, self.width):
+                    tile = np.asarray(Image.fromarray(tile).resize((self.width, self.height)))
+                fetched[index] = tile
+                self.tile_cache[index] = tile
+        return np.stack([fetched[index] for index in indices])
+
+    def composite(self, indices, rows, cols, show_progress=True):
+        """
+        write the selected tiles straight into one output array, row by row
+        :param indices: (rows * cols,) tile ids in raster order
+        :return: (rows * height, cols * width, 3) uint8 array
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(rows, cols)
+        result = np.empty((rows, self.height, cols, self.width, 3), dtype=np.uint8)
+        progress = metrics.Progress(rows) if show_progress else None
+        with metrics.stage('paste', rows * cols):
+            for row in range(rows):
+                result[row] = self.get_tile_arrays(indices[row]).transpose(1, 0, 2, 3)
+                if progress:
+                    progress.update(row + 1)
+        return result.reshape(rows * self.height, cols * self.width, 3)
+
+    def get_thumbnails(self, indices):
+        """
+        small tiles for previews, all of them are read into memory on first use
+        :param indices: tile ids, as returned by the find methods
+        :return: (len(indices), size, size, 3) uint8 array, size is the stored size closest to PREVIEW_TILE_SIZE
+        """
+        if self.thumbnails is None:
+            level = self.structure.get_level(settings.PREVIEW_TILE_SIZE)
+            self.thumbnails = np.array(self.structure.load_tiles(level)[:])
+        return self.thumbnails[np.asarray(indices, dtype=np.int64)]
+
+    def composite_thumbnails(self, indices, rows, cols):
+        """
+        same as composite, with thumbnails
+        :return: (rows * size, cols * size, 3) uint8 array, see get_thumbnails
+        """
+        with metrics.stage('paste', rows * cols):
+            thumbnails = self.get_thumbnails(indices)
+            size = thumbnails.shape[1]
+            return thumbnails.reshape(rows, cols, size, size, 3).transpose(0, 2, 1, 3, 4).reshape(
+                rows * size, cols * size, 3)
+
+    def generate_color_space(self):
+        """
+        load the color lookup table of this database, building and caching it to disk if not found
+        """
+        if self.features is None:
+            raise ValueError('Please call process_images first')
+        bins = settings.COLOR_SPACE_BINS
+        filename = self.structure.get_color_space_filename(self.level, bins, len(self.features))
+        if os.path.isfile(filename):
+            table = np.load(filename)
+        else:
+            print('Generating color space | {} bins | {}'.format(bins ** 3, len(self.features)), end='')
+            start_time = time.time()
+            table = matching.ColorLookupTable.build(self.features, bins)
+            utilities.save_array(filename, table)
+            print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+        self.color_space = matching.ColorLookupTable(self.features, table, self.color_index.left())
+
+    def describe(self, source, size):
+        """
+        features of every size x size chunk of source to pass to the find methods, call after process_images
+        :return: (rows, cols, 3) average colors, or (rows, cols, DESCRIPTOR_COMPONENTS) reduced descriptors
+        """
+        if self.pca is None:
+            return ImageItem.get_grid_avg(source, size)
+        cells = ImageItem.get_cell_avg(source, size, settings.DESCRIPTOR_GRID)
+        rows, cols = cells.shape[:2]
+        if settings.DESCRIPTOR_LAB:
+            cells = colors.rgb_to_lab(cells.reshape(-1, 3))
+        return self.pca.transform(cells.reshape(rows * cols, -1)).reshape(rows, cols, -1)
+
+    def _kd_tree_space(self, rgb):
+        if self.pca is not None:
+            return np.asarray(rgb, dtype=np.float64)
+        return colors.color_spaces[settings.KD_TREE_COLOR_SPACE](rgb)
+
+    def generate_kd_tree(self):
+        if self.features is None:
             raise ValueError('Please call process_images first')
+        print('Generating kd tree | {}'.format(len(self.features)), end='')
+        start_time = time.time()
+        self.kd_tree = matching.KDTree(self._kd_tree_space(self.features), point_counts=self.color_index.left())
+        print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+
+    def _method_space(self, method):
+        """
+        :return: features of the database in the space method works in, and function converting rgb to that space
+        """
+        if self.pca is not None:
+            return self.features, np.asarray
+        if method in matching.lab_metrics:
+            return self.lab_features, colors.rgb_to_lab
+        if method == 'kd tree':
+            return self._kd_tree_space(self.features), self._kd_tree_space
+        return self.features, np.asarray
+
+    def _get_matcher(self, method):
+        if self.matcher is None or self.matcher.metric is not matching.metrics[method]:
+            self.matcher = matching.BatchMatcher(self._method_space(method)[0], method, counts=self.color_index.left())
+        return self.matcher
+
+    methods = ('color space', 'kd tree') + tuple(matching.metrics)
+
+    def find_closest(self, other, use_repeat, method='euclidean optimized'):
         other = ImageItem(other, self.width, self.height)
-        return getattr(self, self.color_diff_methods[method])(other, use_repeat)
-
-    def find_closest_in_color_space(self, other, use_repeat):
-        R, G, B = other.avg_r, other.avg_g, other.avg_b
-
-        r = int(R / 255 * (len(self.color_space) - 1) + 0.5)
-        g = int(G / 255 * (len(self.color_space[r]) - 1) + 0.5)
-        b = int(B / 255 * (len(self.color_space[r][g]) - 1) + 0.5)
-        item = self.color_space[r][g][b][0]
-        if not use_repeat:
-            self.color_space[r][g][b].remove(item)
-            if not self.color_space[r][g][b]:
-                self.color_space[r][g].remove(self.color_space[r][g][b])
-                if not self.color_space[r][g]:
-                    self.color_space[r].remove(self.color_space[r][g])
-                    if not self.color_space[r]:
-                        self.color_space.remove(self.color_space[r])
-        return item
-
-    def remove(self, img):
-        for three_d_array in self.color_space:
-            for two_d_array in three_d_array:
-                for array in two_d_array:
-                    if img in array:
-                        array.remove(img)
+        return self.get_tile(self.find_closest_index((other.avg_r, other.avg_g, other.avg_b), use_repeat, method))
 
-    @staticmethod
-    def _load(inputs):
-        return ImageItem(utilities.load(inputs[0]), inputs[1], inputs[2])  # file width and height
+    def find_closest_index(self, rgb, use_repeat, method='euclidean'):
+        """
+        :param rgb: average color of the chunk
+        :return: tile id, see get_tile
+        """
+        return int(self.find_closest_batch(np.array([rgb]), use_repeat, method)[0])
+
+    def find_closest_batch(self, others, use_repeat, method='euclidean'):
+        """
+        find closest images for a whole block of chunks at once
+        :param others: (B, 3) array of average colors of the chunks, in order
+        :return: (B,) array of tile ids, see get_tile
+        """
+        with metrics.stage('match', len(others)):
+            return self._find_closest_batch(others, use_repeat, method)
+
+    def _find_closest_batch(self, others, use_repeat, method):
+        if self.features is None:
+            raise ValueError('Please call process_images first')
+        if method not in self.methods:
+            raise ValueError('Unknown color difference method: {}'.format(method))
+        if self.pca is not None and method != 'kd tree':
+            method = 'euclidean'  # descriptors are only compared by distance
+        if self.streaming:
+            return self._find_streaming(others, use_repeat, method)
+        if not use_repeat and settings.NO_REPEAT_ASSIGNMENT == 'global':
+            return self.assign_global(others, method)
+        if method == 'kd tree':
+            if self.kd_tree is None:
+                self.generate_kd_tree()
+            result = self.kd_tree.match(self._kd_tree_space(others), use_repeat)
+        elif method == 'color space':
+            if self.color_space is None:
+                self.generate_color_space()
+            result = self.color_space.match(others, use_repeat)
+        else:
+            _, to_space = self._method_space(method)
+            result = self._get_matcher(method).match(to_space(others), use_repeat)
+        return self.color_index.to_tiles(result, use_repeat)
+
+    def _find_streaming(self, others, use_repeat, method):
+        """
+        find_closest_batch reading the database features block by block within MATCH_MEMORY_BUDGET,
+        'kd tree' and 'color space' are searched exhaustively with the same distance instead
+        """
+        if method in matching.metrics:
+            metric = method
+        elif method == 'kd tree' and settings.KD_TREE_COLOR_SPACE == 'lab' and self.pca is None:
+            metric = 'cie76'
+        else:
+            metric = 'euclidean'
+        features, to_space = self._method_space(metric)
+        if not isinstance(self.matcher, matching.StreamingMatcher) or self.matcher.metric is not matching.metrics[metric]:
+            self.matcher = matching.StreamingMatcher(features, metric)
+        if not use_repeat and settings.NO_REPEAT_ASSIGNMENT == 'global':
+            return self.matcher.assign(to_space(others))
+        return self.matcher.match(to_space(others), use_repeat)
+
+    def assign_global(self, others, method='euclidean'):
+        """
+        match all chunks at once such that no image is used twice and the total difference is low
+        :return: (B,) array of distinct tile ids, see get_tile
+        """
+        print('Solving global assignment | {} chunks'.format(len(others)), end='')
+        start_time = time.time()
+        features, to_space = self._method_space(method)
+        metric = method if method in matching.metrics else 'euclidean'
+        # one feature per tile left, so colors shared by several tiles can be assigned several times
+        tile_colors = np.repeat(np.arange(len(features)), self.color_index.left())
+        result = matching.solve_assignment(to_space(others), features[tile_colors], metric)
+        result = self.color_index.to_tiles(tile_colors[result], use_repeat=False)
+        print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
+        return result
 
     @staticmethod
     def load(folder, width, height):
@@ -214,28 +618,64 @@ class ImageDatabase(object):
 
         database_structure = utilities.get_database_structure(folder)
 
+        if not database_structure.has_tile_store():
+            if not database_structure.has_legacy_chunks():
+                raise ValueError('No database found in {}'.format(database_structure.folder))
+            database_structure.migrate_legacy_chunks()
+
         database = ImageDatabase(width, height, folder)
 
         start_time = time.time()
-        chunks = database_structure.get_list_names()
-        total = len(chunks)
-
-        print('Loading {} chunks from {}'.format(total, database_structure.image_folder))
-
-        database.images = []
-        for index, chunk in enumerate(chunks):
-            database.images += [ImageItem(image, database.width, database.height) for image in utilities.load(chunk)]
-            utilities.print_progress(index + 1, total)
-            if settings.MAX_CHUNKS_USE and settings.MAX_CHUNKS_USE == index + 1:
-                print('Reached limit for max chunks use')
-                break
-        utilities.print_done(time.time() - start_time)
+        print('Loading tiles from {}'.format(database_structure.get_tiles_filename(database.level)), end='')
+        with metrics.stage('load'):
+            database.tiles = database_structure.open_tiles(database.level)
+            database.level_features, database.level_lab, database.filenames = \
+                database_structure.load_features(mmap=True)
+            database.tile_features = database.level_features[database.level]
+            database.tile_lab = database.level_lab[database.level]
+        print(' [ done ] => {0:.2f}s'.format(time.time() - start_time))
 
         return database
 
+    def reserve(self, tiles):
+        """
+        mark tiles as used for matching without repeat, call after process_images and before finding
+        :param tiles: tile ids, as returned by the find methods
+        """
+        if self.streaming:
+            raise ValueError('Cannot reserve tiles when streaming features from disk')
+        if self.matcher is not None or self.kd_tree is not None or self.color_space is not None:
+            raise ValueError('Please reserve tiles before finding')
+        self.color_index.reserve(tiles)
+
+    def view(self):
+        """
+        copy sharing tiles, features and the tile cache, with matching state of its own,
+        so several mosaics can be made from one loaded database at the same time
+        :return: processed ImageDatabase
+        """
+        database = copy.copy(self)
+        database.process_images()
+        database.tile_cache = self.tile_cache
+        return database
+
+    def __len__(self):
+        """
+        :return: number of tiles matched against, limited by MAX_CHUNKS_USE as in process_images
+        """
+        if self.tile_features is None:
+            return 0
+        if settings.MAX_CHUNKS_USE:
+            return min(len(self.tile_features), settings.MAX_CHUNKS_USE * settings.MAX_CACHE_PROCESSED_IMAGES)
+        return len(self.tile_features)
+
     @property
     def size(self):
-        if self.rgb_image_dict:
-            return len(self.rgb_image_dict)
-        else:
+        """
+        :return: number of tiles that can still be used without repeat
+        """
+        if self.features is None:
             raise ValueError('Please process images before calling .size')
+        if self.streaming:
+            return int(self.matcher.available.sum()) if self.matcher else len(self.features)
+        return len(self.color_index)
@@ -1,12 +1,16 @@
 import argparse
+import json
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
 from items import ImageDatabase
 from PIL import Image
 import settings
 import os
 import pickle
-from glob import glob
 import math
+import metrics
+import numpy as np
 import time
 import utilities
 
@@ -17,51 +21,31 @@ def _load_database(folder, size, repeat, pieces_required):
     database_folder = utilities.get_database_structure(folder).folder
 
     # first, try load from existing database if exists
-    if os.path.isdir(database_folder) and (
-            size < settings.DATABASE_IMAGE_WIDTH or size < settings.DATABASE_IMAGE_HEIGHT):
+    if os.path.isdir(database_folder):
         try:
             # try to load files existing database
             print('Attempting to load database from folder: {}'.format(database_folder))
             existing_database = ImageDatabase.load(folder, size, size)
-
-            number_of_images_in_existing_database = len(existing_database.images)
-
-            if not repeat and number_of_images_in_existing_database < pieces_required:
-                raise ValueError('Existing database does not contain enough pictures: {} < {}'.format(
-                    number_of_images_in_existing_database, pieces_required))
-
-            number_of_images_in_specified_folder = len(glob(folder + '/*[jpg|png]'))
-
-            #
-            # if number of images are the same then high chance database is unchanged,
-            # return if settings allowed to return
-            #
-            if number_of_images_in_existing_database == number_of_images_in_specified_folder \
-                    and settings.ALLOW_USE_EXISING_IF_SEEM_SAME:
-                # print('Existing database seem to be coherent {} == {}'.format(number_of_images_in_specified_folder,
-                #                                                               number_of_images_in_existing_database))
-                return existing_database
-            # ask if they want to use the existing database if reached here
-            while True:
-                ans = input('Existing database found with size requirement satisfied, ' + os.linesep +
-                            'existing database:{}, specified folder:{}, use existing? [y/n]:'.format(
-                                number_of_images_in_existing_database,
-                                number_of_images_in_specified_folder))
-                if ans == 'y':
-                    return existing_database
-                elif ans == 'n':
-                    break
-                print('Please give answer as \'y\' or \'n\'')
-
         except pickle.PicklingError:  # raise when failed checking before loading database
             print('Failed to load existing database: {}'.format(database_folder))
         except ValueError as e:  # raise by internal checking
             print(e)
-        except EOFError:  # raise when loading fails
+        except (EOFError, OSError):  # raise when loading fails
             print('Data is corrupted in existing database {}'.format(database_folder))
+        else:
+            # decode only new or changed images, drop deleted ones,
+            # errors reading library images are raised as is, the database is left as it was
+            existing_database.refresh()
+
+            number_of_images_in_existing_database = len(existing_database)
+
+            if repeat or number_of_images_in_existing_database >= pieces_required:
+                return existing_database
+            print('Existing database does not contain enough pictures: {} < {}'.format(
+                number_of_images_in_existing_database, pieces_required))
 
     #
-    # database folder does not exists or user wants to create new database if reached here
+    # database folder does not exists or existing database cannot be used if reached here
     #
     print('Creating new database from folder: {}'.format(folder))
 
@@ -90,11 +74,21 @@ def _load_database(folder, size, repeat, pieces_required):
     return database
 
 
-def make_from(source, folder, size, factor, use_repeat=True):
+def resize_source(source, size, factor, use_repeat, method):
+    """
+    :return: source resized by factor, number of pieces required
+    """
+    width, height, pieces_required = get_dimension(source, size, factor, use_repeat, method)
+    return source.resize((width, height)), pieces_required
+
+
+def get_dimension(source, size, factor, use_repeat, method):
+    """
+    :return: width and height of source resized by factor, number of pieces required
+    """
     src_width, src_height = source.size
     width = int(src_width * factor)
     height = int(src_height * factor)
-    source = source.resize((width, height))
 
     pieces_required = math.ceil(width / size) * math.ceil(height / size)
 
@@ -103,40 +97,194 @@ def make_from(source, folder, size, factor, use_repeat=True):
     print('result dimension:', width, height)
     print('total pieces:', pieces_required)
     print('repeat:', use_repeat)
-    print('algorithm:', settings.COLOR_DIFF_METHOD)
+    print('algorithm:', method)
     print('=' * 50)
 
     if size < 1 or size < 1:
         raise ValueError('width or height for each small piece of images is less than 1px: {} {} < {}'.format(
             width, height, size))
 
+    return width, height, pieces_required
+
+
+def make_from(source, folder, size, factor, use_repeat=True, on_preview=None, refine=True):
+    """
+    :param on_preview: if given, called with a quick low resolution mosaic made before the full one
+    :param refine: make the full mosaic after the preview, else return None for it
+    :return: source resized, the mosaic
+    """
+    method = settings.COLOR_DIFF_METHOD
+    source, pieces_required = resize_source(source, size, factor, use_repeat, method)
+
     database = _load_database(folder, size, use_repeat, pieces_required)
-    database.process_images()
+    if on_preview is None:
+        database.process_images()
+        return source, make_with(database, source, size, use_repeat, method)
+
+    preview, coarse = make_preview(database, source, size, use_repeat, method)
+    on_preview(preview)
+    if not refine:
+        return source, None
+    return source, refine_preview(database, source, size, use_repeat, method, coarse)
+
+
+def make_preview(database, source, size, use_repeat, method):
+    """
+    match chunks of PREVIEW_GRID x PREVIEW_GRID pieces and draw them with thumbnails
+    :return: the preview, (average colors, tile ids) of the chunks to refine_preview from
+    """
+    print('building preview ...')
+    start_time = time.time()
+    width, height = source.size
+    chunk_size = size * settings.PREVIEW_GRID
+    view = database.view()
+    with metrics.stage('source feature'):
+        grid = view.describe(source, chunk_size)
+    rows, cols = grid.shape[:2]
+    indices = view.find_closest_batch(grid.reshape(rows * cols, -1), use_repeat, method=method)
+    preview = database.composite_thumbnails(indices, rows, cols)
+    scale = preview.shape[0] / rows / chunk_size
+    preview = Image.fromarray(preview[:max(1, round(height * scale)), :max(1, round(width * scale))])
+    utilities.print_done(time.time() - start_time)
+    return preview, (grid, indices)
+
+
+def refine_preview(database, source, size, use_repeat, method, coarse):
+    """
+    make the full mosaic, pieces with average color close to their preview chunk keep its image,
+    only the others are matched again
+    :param coarse: as returned by make_preview
+    :return: the mosaic, same size as source
+    """
+    print('refining preview ...')
+    start_time = time.time()
+    width, height = source.size
+    view = database.view()
+    with metrics.stage('source feature'):
+        grid = view.describe(source, size)
+    rows, cols = grid.shape[:2]
+    features = grid.reshape(rows * cols, -1)
+
+    coarse_grid, coarse_indices = coarse
+    scale = settings.PREVIEW_GRID
+    reference = coarse_grid.repeat(scale, axis=0).repeat(scale, axis=1)[:rows, :cols].reshape(rows * cols, -1)
+    indices = np.asarray(coarse_indices).reshape(coarse_grid.shape[:2]) \
+        .repeat(scale, axis=0).repeat(scale, axis=1)[:rows, :cols].ravel().copy()
+    changed = np.abs(features - reference).max(axis=1) > settings.PREVIEW_REUSE_THRESHOLD
+
+    if not use_repeat and view.streaming:
+        changed[:] = True  # tiles cannot be reserved when streaming features from disk
+    elif not use_repeat:
+        # each image of the preview can stay with one of the pieces of its chunk only
+        kept = np.flatnonzero(~changed)
+        _, first = np.unique(indices[kept], return_index=True)
+        changed[np.delete(kept, first)] = True
+        view.reserve(indices[~changed])
+    metrics.count('pieces matched', int(changed.sum()))
+    metrics.count('pieces reused', int((~changed).sum()))
+    if changed.any():
+        indices[changed] = view.find_closest_batch(features[changed], use_repeat, method=method)
+    utilities.print_done(time.time() - start_time)
+
+    print('compositing image ...')
+    start_time = time.time()
+    background = Image.fromarray(view.composite(indices, rows, cols)[:height, :width])
+    utilities.print_done(time.time() - start_time)
+    return background
+
+
+def make_with(database, source, size, use_repeat, method):
+    """
+    :param database: processed ImageDatabase of size
+    :param source: resized source
+    :return: the mosaic, same size as source
+    """
+    width, height = source.size
 
     print('=' * 50)
     print('Database size:', database.size)
     print('=' * 50)
 
-    chunk_count = 0
-    background = Image.new(source.mode, source.size, 'black')
     print('building image from database ...')
     start_time = time.time()
-    for h in range(0, height, size):
-        for w in range(0, width, size):
-            btmx = w + size
-            btmy = h + size
-            if btmx > width:
-                btmx = width
-            if btmy > height:
-                btmy = height
-            curr_chunk = source.crop((w, h, btmx, btmy))
-            best_match = database.find_closest(curr_chunk, use_repeat, method=settings.COLOR_DIFF_METHOD)
-            background.paste(best_match, (w, h))
-            chunk_count += 1
-            utilities.print_progress(chunk_count, pieces_required)
+    with metrics.stage('source feature'):
+        grid = database.describe(source, size)
+    rows, cols = grid.shape[:2]
+    features = grid.reshape(rows * cols, -1)
+    indices = database.find_closest_batch(features, use_repeat, method=method)
     utilities.print_done(time.time() - start_time)
 
-    return source, background
+    print('compositing image ...')
+    start_time = time.time()
+    background = Image.fromarray(database.composite(indices, rows, cols)[:height, :width])
+    utilities.print_done(time.time() - start_time)
+
+    return background
+
+
+def make_streaming(database, source, size, factor, use_repeat, method, folder, blend_levels=None):
+    """
+    make the mosaic STREAM_STRIP_ROWS rows of pieces at a time, each strip of source is resized, matched, composited,
+    blended and appended to png files before the next, so memory used does not grow with the size of the result
+    :param database: processed ImageDatabase of size
+    :param source: source, not resized
+    :param blend_levels: default 0.0 to 0.9
+    :return: list of files saved, same as save_outputs
+    """
+    src_width, src_height = source.size
+    width, height = int(src_width * factor), int(src_height * factor)
+
+    print('=' * 50)
+    print('Database size:', database.size)
+    print('=' * 50)
+
+    print('building image strip by strip ...')
+    start_time = time.time()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    background_file = folder + '/background_{}.png'.format('repeat' if use_repeat else 'no_repeat')
+    blend_levels = blend_levels if blend_levels else [index / 10 for index in range(10)]
+    files = [background_file] + [folder + '/{}.png'.format(blend_percent) for blend_percent in blend_levels]
+    writers = [utilities.PNGWriter(file, width, height) for file in files]
+    strip_height = size * settings.STREAM_STRIP_ROWS
+    recorder = metrics.current()
+    progress = metrics.Progress(height)
+
+    def blend_and_write(writer, strip, background, blend_percent):
+        if blend_percent is None:
+            image = background
+        else:
+            with recorder.stage('blend', 1):
+                image = Image.blend(strip, background, blend_percent)
+        with recorder.stage('encode', 1):
+            writer.write(np.asarray(image))
+
+    try:
+        with ThreadPoolExecutor(max_workers=settings.ENCODE_WORKERS or os.cpu_count() or 1) as executor:
+            for top in range(0, height, strip_height):
+                bottom = min(top + strip_height, height)
+                with metrics.stage('resize', 1):
+                    strip = source.resize((width, bottom - top),
+                                          box=(0, top / factor, src_width, min(bottom / factor, src_height)))
+                with metrics.stage('source feature'):
+                    grid = database.describe(strip, size)
+                rows, cols = grid.shape[:2]
+                indices = database.find_closest_batch(grid.reshape(rows * cols, -1), use_repeat, method=method)
+                background = database.composite(indices, rows, cols, show_progress=False)[:bottom - top, :width]
+                background = Image.fromarray(background)
+                futures = [executor.submit(blend_and_write, writer, strip, background, blend_percent)
+                           for writer, blend_percent in zip(writers, [None] + blend_levels)]
+                for future in futures:
+                    future.result()
+                progress.update(bottom)
+        for writer in writers:
+            writer.close()
+    finally:
+        for writer in writers:
+            writer.file.close()
+    print()
+    utilities.print_done(time.time() - start_time)
+    return files
 
 
 def main():
@@ -147,30 +295,235 @@ def main():
     parser.add_argument('-d', '--dest', help='the base name of the output file, not including extension')
     parser.add_argument('-r', '--repeat', action='store_true', help='allow build with repeating images')
     parser.add_argument('-fa', '--factor', type=int, help='result size factor compared to original')
+    parser.add_argument('-b', '--blend', type=float, nargs='+',
+                        help='blend levels of result over source to save, between 0 and 1, default 0.0 to 0.9')
+    parser.add_argument('-fmt', '--format', default='jpg', help='extension of output files, default jpg')
+    parser.add_argument('-q', '--quality', type=int, help='encoder quality of output files, e.g. jpeg 1-95')
+    parser.add_argument('-m', '--metrics', help='save time spent in each stage as json to this file')
+    parser.add_argument('-p', '--profile', help='run under cProfile and save stats to this file, see python -m pstats')
+    parser.add_argument('-pv', '--preview', action='store_true', help='save a quick preview before the full result')
+    parser.add_argument('-pvo', '--preview-only', action='store_true', help='save only the quick preview')
+    parser.add_argument('-st', '--stream', action='store_true',
+                        help='make and save the result strip by strip as png, for results too large for memory')
+    parser.add_argument('-bt', '--batch', help='json list of jobs to run over the database of --folder, '
+                                               'each with "source" and optionally any of "size", "factor", '
+                                               '"repeat", "method", "dest", "blend", "format", "quality", '
+                                               '"stream"')
     args = parser.parse_args()
 
+    if args.batch:
+        run_batch(args)
+        return
+
+    if args.profile:
+        with metrics.profile(args.profile):
+            run(args)
+    else:
+        run(args)
+
+    print('=' * 50)
+    metrics.current().print_summary()
+    if args.metrics:
+        metrics.current().save(args.metrics)
+        print('Metrics saved to {}'.format(args.metrics))
+
+
+def run(args):
     input_file = args.source
     database_folder = args.folder
     src = Image.open(input_file).convert('RGB')
-    source, background = make_from(src, database_folder, args.size, args.factor, use_repeat=args.repeat)
+    if args.stream:
+        if args.preview or args.preview_only:
+            raise ValueError('Preview cannot be made with --stream')
+        if args.format != 'png':
+            raise ValueError('--stream only saves png, please use -fmt png')
+        method = settings.COLOR_DIFF_METHOD
+        _, _, pieces_required = get_dimension(src, args.size, args.factor, args.repeat, method)
+        database = _load_database(database_folder, args.size, args.repeat, pieces_required)
+        database.process_images()
+        make_streaming(database, src, args.size, args.factor, args.repeat, method, args.dest, args.blend)
+        return
+    on_preview = None
+    if args.preview or args.preview_only:
+        def on_preview(preview):
+            if not os.path.isdir(args.dest):
+                os.makedirs(args.dest)
+            preview_file = args.dest + '/preview.' + args.format
+            preview.save(preview_file, **save_options(args.quality))
+            print('Preview saved to {}'.format(preview_file))
+    source, background = make_from(src, database_folder, args.size, args.factor, use_repeat=args.repeat,
+                                   on_preview=on_preview, refine=not args.preview_only)
+    if background is None:
+        return
+    save_outputs(source, background, args.dest, args.repeat, args.blend, args.format, args.quality)
+
+
+def run_job(database, options, dest):
+    """
+    make and save one mosaic from a loaded database
+    :param options: dict of source, size and optionally factor, repeat, method, dest, blend, format, quality, stream
+    :param dest: folder to save to if options has no dest
+    :return: list of files saved
+    """
+    if options.get('stream') and (options.get('format') or 'jpg') != 'png':
+        raise ValueError('stream only saves png, please use format png')
+    size = int(options['size'])
+    use_repeat = bool(options.get('repeat', False))
+    method = options.get('method') or settings.COLOR_DIFF_METHOD
+    factor = float(options.get('factor') or 1)
+    source = Image.open(options['source']).convert('RGB')
+    _, _, pieces_required = get_dimension(source, size, factor, use_repeat, method)
+    if not use_repeat and len(database) < pieces_required:
+        raise ValueError('Database does not contain enough pictures: {} < {}'.format(len(database), pieces_required))
+    if options.get('stream'):
+        return make_streaming(database.view(), source, size, factor, use_repeat, method,
+                              options.get('dest') or dest, options.get('blend'))
+    source = source.resize((int(source.size[0] * factor), int(source.size[1] * factor)))
+    background = make_with(database.view(), source, size, use_repeat, method)
+    return save_outputs(source, background, options.get('dest') or dest, use_repeat,
+                        options.get('blend'), options.get('format') or 'jpg', options.get('quality'))
+
+
+# databases loaded in a batch worker process, size -> ImageDatabase, reused by all jobs of the worker
+batch_folder = None
+batch_databases = dict()
+
+
+def _init_batch_worker(folder):
+    global batch_folder
+    batch_folder = folder
+    batch_databases.clear()
+    settings.PROGRESS_INTERVAL = None  # progress lines of workers would overwrite each other
+
+
+def _run_batch_job(job):
+    """
+    used by batch worker processes, tiles are memory mapped read only so workers share them through the page cache
+    :param job: (index, options, default dest)
+    :return: dict of the result of the job
+    """
+    index, options, dest = job
+    start_time = time.time()
+    outputs, error = [], None
+    with metrics.collect() as recorder:
+        try:
+            size = int(options['size'])
+            if size not in batch_databases:
+                batch_databases[size] = ImageDatabase.load(batch_folder, size, size)
+            outputs = run_job(batch_databases[size], options, dest)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'index': index,
+        'options': options,
+        'outputs': outputs,
+        'error': error,
+        'seconds': time.time() - start_time,
+        'metrics': recorder.to_dict(),
+    }
+
+
+def run_batch(args):
+    """
+    run every job of the batch file in BATCH_WORKERS processes over one database, options not given by a job
+    are taken from the command line
+    """
+    with open(args.batch) as file:
+        jobs = json.load(file)
+    defaults = {'size': args.size, 'factor': args.factor, 'repeat': args.repeat, 'method': None,
+                'blend': args.blend, 'format': args.format, 'quality': args.quality}
+    jobs = [dict(defaults, **job) for job in jobs]
+    for index, job in enumerate(jobs):
+        if not job.get('source') or not job.get('size'):
+            raise ValueError('Job {} of {} needs source and size'.format(index, args.batch))
+        if job['method'] and job['method'] not in ImageDatabase.methods:
+            raise ValueError('Unknown color difference method of job {}: {}'.format(index, job['method']))
+    dest = args.dest or 'output'
+
+    # bring the database up to date once, workers then only load it
+    _load_database(args.folder, int(jobs[0]['size']), True, 0)
+
+    print('Running {} jobs ...'.format(len(jobs)))
+    start_time = time.time()
+    tasks = [(index, job, os.path.join(dest, str(index))) for index, job in enumerate(jobs)]
+    workers = min(settings.BATCH_WORKERS or os.cpu_count() or 1, len(jobs))
+    results = []
+    progress = metrics.Progress(len(tasks))
+    if workers > 1:
+        with Pool(workers, initializer=_init_batch_worker, initargs=(args.folder,)) as pool:
+            for result in pool.imap_unordered(_run_batch_job, tasks):
+                results.append(result)
+                progress.update(len(results))
+    else:
+        _init_batch_worker(args.folder)
+        for task in tasks:
+            results.append(_run_batch_job(task))
+    utilities.print_done(time.time() - start_time)
 
+    results.sort(key=lambda result: result['index'])
+    print('=' * 50)
+    print('{:<6}{:<32}{:>6}{:>10}{:>10}  {}'.format('job', 'source', 'size', 'seconds', 'match', 'result'))
+    for result in results:
+        match = result['metrics']['stages'].get('match', {}).get('seconds')
+        print('{:<6}{:<32}{:>6}{:>10.2f}{:>10}  {}'.format(
+            result['index'], str(result['options']['source'])[-32:], result['options']['size'], result['seconds'],
+            '-' if match is None else '{:.2f}'.format(match),
+            result['error'] or '{} files'.format(len(result['outputs']))))
+    failed = sum(1 for result in results if result['error'])
+    print('{} done, {} failed'.format(len(results) - failed, failed))
+    if args.metrics:
+        with open(args.metrics, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Metrics saved to {}'.format(args.metrics))
+
+
+def save_outputs(source, background, folder, use_repeat, blend_levels=None, extension='jpg', quality=None):
+    """
+    save background and its blends over source to folder
+    :param blend_levels: default 0.0 to 0.9
+    :return: list of files saved
+    """
     print('Blending & saving images ... ')
 
-    folder = args.dest
     if not os.path.isdir(folder):
-        os.mkdir(folder)
-
-    background_file = folder + '/background_{}.jpg'
-    background.save(background_file.format('repeat' if args.repeat else 'no_repeat'))
-
-    output_file = folder + '/{}.jpg'
-    blend_range = 10
-    for index, blend_percent in enumerate(range(0, blend_range)):
-        blend_percent = blend_percent / blend_range
-        image = Image.blend(source, background, blend_percent)
-        image.save(output_file.format(blend_percent))
-        utilities.print_progress(index+1, blend_range)
+        os.makedirs(folder)
+
+    background_file = (folder + '/background_{}.' + extension).format('repeat' if use_repeat else 'no_repeat')
+    with metrics.stage('encode', 1):
+        background.save(background_file, **save_options(quality))
+
+    blend_levels = blend_levels if blend_levels else [index / 10 for index in range(10)]
+    files = save_blends(source, background, blend_levels, folder + '/{}.' + extension, quality=quality)
     utilities.print_done(folder)
+    return [background_file] + files
+
+
+def save_options(quality):
+    return dict() if quality is None else dict(quality=quality)
+
+
+def save_blends(source, background, blend_levels, output_file, quality=None):
+    """
+    blend background over source at each level and save them, encoding in ENCODE_WORKERS threads
+    :param output_file: filename with a placeholder for the blend level
+    :return: list of files saved, in order of blend_levels
+    """
+    options = save_options(quality)
+    recorder = metrics.current()
+
+    def blend_and_save(blend_percent):
+        with recorder.stage('blend', 1):
+            image = Image.blend(source, background, blend_percent)
+        with recorder.stage('encode', 1):
+            image.save(output_file.format(blend_percent), **options)
+
+    progress = metrics.Progress(len(blend_levels))
+    with ThreadPoolExecutor(max_workers=settings.ENCODE_WORKERS or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(blend_and_save, blend_percent) for blend_percent in blend_levels]
+        for index, future in enumerate(as_completed(futures)):
+            future.result()
+            progress.update(index + 1)
+    return [output_file.format(blend_percent) for blend_percent in blend_levels]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,708 @@
+import numpy as np
+
+import colors
+import settings
+
+
+def euclidean_dist(targets, features):
+    """
+    squared euclidean distance between every target and every feature
+    :param targets: (B, D) array of colors or descriptors
+    :param features: (N, D) array of colors or descriptors
+    :return: (B, N) array of distances, exact integers if both inputs are integers
+    """
+    dtype = np.result_type(targets, features, np.int64)
+    targets = targets.astype(dtype)
+    features = features.astype(dtype)
+    dist = np.zeros((len(targets), len(features)), dtype=dtype)
+    for channel in range(targets.shape[1]):
+        diff = targets[:, channel, None] - features[None, :, channel]
+        dist += diff * diff
+    return dist
+
+
+def euclidean_optimized_dist(targets, features):
+    """
+    weighted euclidean distance, see https://en.wikipedia.org/wiki/Color_difference
+    :param targets: (B, 3) array of colors
+    :param features: (N, 3) array of colors
+    :return: (B, N) array of distances
+    """
+    targets = targets.astype(np.float64)
+    features = features.astype(np.float64)
+    r_avg = (targets[:, 0, None] + features[None, :, 0]) / 2
+    dr = targets[:, 0, None] - features[None, :, 0]
+    dg = targets[:, 1, None] - features[None, :, 1]
+    db = targets[:, 2, None] - features[None, :, 2]
+    return (2 + (r_avg / 256)) * (dr ** 2) + 4 * (dg ** 2) + (2 + ((255 - r_avg) / 256)) * (db ** 2)
+
+
+metrics = {
+    'euclidean': euclidean_dist,
+    'euclidean optimized': euclidean_optimized_dist,
+    'cie76': colors.cie76,
+    'cie94': colors.cie94,
+    'ciede2000': colors.ciede2000,
+    'cmc': lambda lab1, lab2: colors.cmc(lab1, lab2, l=settings.CMC_L, c=settings.CMC_C),
+}
+
+# metrics taking Lab colors instead of rgb
+lab_metrics = {'cie76', 'cie94', 'ciede2000', 'cmc'}
+
+
+class BatchMatcher(object):
+    """
+    Scores blocks of targets against the whole feature matrix at once
+
+    Variables:
+        self.features
+        self.metric
+        self.batch_size
+        self.counts  # number of times each feature can still be matched without repeat
+        self.available
+    """
+
+    def __init__(self, features, metric, batch_size=None, counts=None):
+        self.features = np.asarray(features)
+        self.metric = metrics[metric] if isinstance(metric, str) else metric
+        self.batch_size = batch_size or settings.MATCH_BATCH_SIZE
+        self.counts = np.ones(len(self.features), dtype=np.int64) if counts is None else np.array(counts)
+        self.available = self.counts > 0
+
+    def iter_blocks(self, targets):
+        for start in range(0, len(targets), self.batch_size):
+            end = start + self.batch_size
+            yield start, end, self.metric(targets[start:end], self.features)
+
+    def match(self, targets, use_repeat):
+        """
+        find the index of the closest feature for every target, in order
+        :param targets: (B, 3) array of colors
+        :param use_repeat: if False, each feature is matched at most once
+        :return: (B,) array of indices into self.features
+        """
+        targets = np.asarray(targets)
+        result = np.empty(len(targets), dtype=np.int64)
+        for start, end, dist in self.iter_blocks(targets):
+            if use_repeat:
+                result[start:end] = np.argmin(dist, axis=1)
+                continue
+            # sequential to keep raster order priority, same as deleting matched items
+            dist = dist.astype(np.float64)
+            for row_index, row in enumerate(dist):
+                if not self.available.any():
+                    raise ValueError('Not enough pictures to match without repeat')
+                row[~self.available] = np.inf
+                index = int(np.argmin(row))
+                self.counts[index] -= 1
+                self.available[index] = self.counts[index] > 0
+                result[start + row_index] = index
+        return result
+
+
+def nearest_candidates(targets, features, metric, k, batch_size=None):
+    """
+    :return: (B, k) indices of the k closest features of each target, and their (B, k) costs, both sorted by cost
+    """
+    metric = metrics[metric] if isinstance(metric, str) else metric
+    batch_size = batch_size or settings.MATCH_BATCH_SIZE
+    k = min(k, len(features))
+    indices = np.empty((len(targets), k), dtype=np.int64)
+    costs = np.empty((len(targets), k), dtype=np.float64)
+    for start in range(0, len(targets), batch_size):
+        dist = metric(targets[start:start + batch_size], features)
+        if k < len(features):
+            part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(len(features)), (len(dist), 1))
+        part_cost = np.take_along_axis(dist, part, axis=1)
+        order = np.argsort(part_cost, axis=1, kind='stable')
+        indices[start:start + len(dist)] = np.take_along_axis(part, order, axis=1)
+        costs[start:start + len(dist)] = np.take_along_axis(part_cost, order, axis=1)
+    return indices, costs
+
+
+def solve_assignment(targets, features, metric, candidates=None, epsilon=None, max_rounds=None):
+    """
+    assign each target a distinct feature minimizing the total cost, see auction. Targets still bidding
+    after max_rounds are given the closest feature left over afterwards, in order.
+    :return: (B,) array of distinct indices into features
+    """
+    targets = np.asarray(targets)
+    features = np.asarray(features)
+    if len(targets) > len(features):
+        raise ValueError('Not enough pictures to match without repeat: {} < {}'.format(
+            len(features), len(targets)))
+
+    def find_candidates(key_targets, k):
+        return nearest_candidates(key_targets, features, metric, k)
+
+    assigned = auction(targets, find_candidates, len(features), candidates, epsilon, max_rounds)
+    left = np.flatnonzero(assigned == -1)
+    if len(left):
+        matcher = BatchMatcher(features, metric)
+        matcher.available[assigned[assigned != -1]] = False
+        assigned[left] = matcher.match(targets[left], use_repeat=False)
+    return assigned
+
+
+def auction(targets, find_candidates, feature_count, candidates=None, epsilon=None, max_rounds=None):
+    """
+    auction where each target only bids on its nearest candidates, the nearest feature beyond them is its
+    outside option. Targets priced out of all their candidates wait until bidding settles, then read at least four
+    times as many and keep bidding at the current prices, so crowded colors widen their search instead of giving up.
+    Identical targets share candidates and bid together for their best objects, one each.
+    :param find_candidates: function of (targets, k) returning (B, k) nearest features and their costs sorted by
+                            cost, -1 and inf where there are fewer, as nearest_candidates
+    :param epsilon: minimum bid increment relative to the range of costs read, see ASSIGNMENT_EPSILON
+    :return: (B,) array of distinct indices into features, -1 for targets still bidding after max_rounds
+    """
+    targets = np.asarray(targets)
+    candidates = min(candidates or settings.ASSIGNMENT_CANDIDATES, feature_count)
+    epsilon = epsilon or settings.ASSIGNMENT_EPSILON
+    max_rounds = max_rounds or settings.ASSIGNMENT_MAX_ROUNDS
+
+    keys, key_of, key_counts = np.unique(targets.reshape(len(targets), -1), axis=0,
+                                         return_inverse=True, return_counts=True)
+    key_of = key_of.ravel()
+    prices = np.zeros(feature_count, dtype=np.float64)
+    owners = np.full(feature_count, -1, dtype=np.int64)
+    assigned = np.full(len(targets), -1, dtype=np.int64)
+    # number of candidates -> [indices, benefits, outside] of keys read with that many, see key_group, key_row
+    groups = dict()
+    key_group = np.zeros(len(keys), dtype=np.int64)
+    key_row = np.zeros(len(keys), dtype=np.int64)
+
+    def read_candidates(group_keys, k):
+        # one extra candidate as the outside option, worth going beyond the candidates for once prices get higher
+        indices, costs = find_candidates(keys[group_keys], k + 1)
+        if indices.shape[1] > k:
+            outside = -costs[:, k]
+            indices, costs = indices[:, :k], costs[:, :k]
+        else:
+            outside = np.full(len(group_keys), -np.inf)
+        rows = 0
+        if k in groups:
+            rows = len(groups[k][0])
+            indices, outside = np.concatenate([groups[k][0], indices]), np.concatenate([groups[k][2], outside])
+            costs = np.concatenate([-groups[k][1], costs])
+        groups[k] = [indices, -costs, outside]
+        key_group[group_keys] = k
+        key_row[group_keys] = rows + np.arange(len(group_keys))
+        return costs
+
+    def cost_range(costs):
+        finite = costs[np.isfinite(costs)]
+        return float(finite.max() - finite.min()) if len(finite) else 0.0
+
+    # the bid increment is relative to the range of costs read so far, which grows as crowded keys read further
+    spread = cost_range(read_candidates(np.arange(len(keys)), candidates)) or 1.0
+
+    for _ in range(max_rounds):
+        bidders = np.flatnonzero(assigned == -1)
+        if not len(bidders):
+            break
+        # waiting bidders of a key, in order, bid for its best, second best ... objects
+        bidders = bidders[np.argsort(key_of[bidders], kind='stable')]
+        bidding_keys, first, waiting = np.unique(key_of[bidders], return_index=True, return_counts=True)
+        key_positions = np.repeat(np.arange(len(bidding_keys)), waiting)
+        ranks = np.arange(len(bidders)) - first[key_positions]
+        objects = np.full(len(bidders), -1, dtype=np.int64)
+        bids = np.zeros(len(bidders), dtype=np.float64)
+        expand = np.zeros(len(bidding_keys), dtype=bool)
+
+        for k, (indices, benefits, outside) in groups.items():
+            in_group = np.flatnonzero(key_group[bidding_keys] == k)
+            if not len(in_group):
+                continue
+            rows = key_row[bidding_keys[in_group]]
+            values = benefits[rows] - prices[np.maximum(indices[rows], 0)]
+            counts = waiting[in_group]
+            # only the best count + 1 objects of each key are bid for or measured against
+            top = min(k, int(counts.max()) + 1)
+            order = np.argpartition(-values, top - 1, axis=1)[:, :top] if top < k else \
+                np.tile(np.arange(k), (len(rows), 1))
+            values = np.take_along_axis(values, order, axis=1)
+            sort = np.argsort(-values, axis=1, kind='stable')
+            order, values = np.take_along_axis(order, sort, axis=1), np.take_along_axis(values, sort, axis=1)
+            line = np.arange(len(rows))
+            last_value = values[line, np.minimum(counts, top) - 1]
+            # the value of the best object left to the others, what each bid is measured against
+            next_value = np.where(counts < top, values[line, np.minimum(counts, top - 1)], -np.inf)
+            next_value = np.maximum(next_value, outside[rows])
+            next_value = np.where(np.isfinite(next_value), next_value, last_value)
+
+            # keys whose bidders would rather have objects beyond their candidates read more instead of bidding
+            enough = (counts <= k) & np.isfinite(last_value) & (last_value >= outside[rows])
+            expand[in_group[~enough]] = True
+            position = np.full(len(bidding_keys), -1, dtype=np.int64)
+            position[in_group[enough]] = np.flatnonzero(enough)
+            selected = np.flatnonzero(position[key_positions] >= 0)
+            line, rank = position[key_positions[selected]], ranks[selected]
+            objects[selected] = indices[rows[line], order[line, rank]]
+            bids[selected] = prices[objects[selected]] + values[line, rank] - next_value[line] + epsilon * spread
+
+        bidding = objects != -1
+        bidders, objects, bids = bidders[bidding], objects[bidding], bids[bidding]
+        if len(bidders):
+            # highest bid wins each object
+            order = np.lexsort((bids, objects))
+            last = np.append(objects[order][1:] != objects[order][:-1], True)
+            winners, won, winning_bids = bidders[order][last], objects[order][last], bids[order][last]
+
+            previous = owners[won]
+            assigned[previous[previous != -1]] = -1
+            owners[won] = winners
+            assigned[winners] = won
+            prices[won] = winning_bids
+            continue
+
+        expanding = bidding_keys[expand]
+        if not len(expanding):
+            break
+        # enough candidates for every target of the key, in powers of two of candidates so few groups are kept
+        wanted = np.maximum(4 * key_group[expanding], key_counts[expanding] + candidates)
+        wanted = np.minimum(candidates * 2 ** np.ceil(np.log2(wanted / candidates)).astype(np.int64), feature_count)
+        for k in np.unique(wanted).tolist():
+            spread = max(spread, cost_range(read_candidates(expanding[wanted == k], k)))
+
+    return assigned
+
+
+class StreamingMatcher(object):
+    """
+    Matches against features read block by block, e.g. memory mapped from disk, so only one block
+    of the database is in memory at a time. Each match reads the features once per pass.
+
+    Variables:
+        self.features  # array like supporting slicing
+        self.metric
+        self.batch_size
+        self.memory_budget  # bytes
+        self.block_size  # number of features read at a time, from memory_budget
+        self.available
+    """
+
+    def __init__(self, features, metric, memory_budget=None, batch_size=None):
+        self.features = features
+        self.metric = metrics[metric] if isinstance(metric, str) else metric
+        self.batch_size = batch_size or settings.MATCH_BATCH_SIZE
+        self.memory_budget = memory_budget or settings.MATCH_MEMORY_BUDGET
+        # a distance matrix and about three temporaries of the same size for each batch of targets
+        self.block_size = max(1, self.memory_budget // (self.batch_size * 8 * 4))
+        self.available = np.ones(len(features), dtype=bool)
+
+    def iter_blocks(self):
+        for start in range(0, len(self.features), self.block_size):
+            yield start, np.asarray(self.features[start:start + self.block_size])
+
+    def candidates(self, targets, k):
+        """
+        running top k over all blocks, only features still available are considered
+        :return: (B, k) indices and (B, k) costs sorted by cost, -1 and inf where there are fewer than k
+        """
+        targets = np.asarray(targets)
+        indices = np.full((len(targets), k), -1, dtype=np.int64)
+        costs = np.full((len(targets), k), np.inf)
+        for start, block in self.iter_blocks():
+            block_available = self.available[start:start + len(block)]
+            if not block_available.any():
+                continue
+            block_k = min(k, len(block))
+            for target_start in range(0, len(targets), self.batch_size):
+                target_end = target_start + self.batch_size
+                dist = self.metric(targets[target_start:target_end], block).astype(np.float64)
+                dist[:, ~block_available] = np.inf
+                if block_k < len(block):
+                    # in order of index, so ties keep the lower index as in BatchMatcher
+                    part = np.sort(np.argpartition(dist, block_k - 1, axis=1)[:, :block_k], axis=1)
+                else:
+                    part = np.tile(np.arange(len(block)), (len(dist), 1))
+                part_cost = np.take_along_axis(dist, part, axis=1)
+                part = np.where(np.isfinite(part_cost), part + start, -1)
+
+                # earlier blocks first, so ties keep the lower index
+                merged = np.concatenate([indices[target_start:target_end], part], axis=1)
+                merged_cost = np.concatenate([costs[target_start:target_end], part_cost], axis=1)
+                order = np.argsort(merged_cost, axis=1, kind='stable')[:, :k]
+                indices[target_start:target_end] = np.take_along_axis(merged, order, axis=1)
+                costs[target_start:target_end] = np.take_along_axis(merged_cost, order, axis=1)
+        return indices, costs
+
+    def match(self, targets, use_repeat):
+        """
+        same as BatchMatcher.match, in no repeat mode each target takes its closest feature still available,
+        in order of targets, see _fill
+        """
+        targets = np.asarray(targets)
+        if use_repeat:
+            return self.candidates(targets, 1)[0][:, 0]
+        return self._fill(targets, np.full(len(targets), -1, dtype=np.int64))
+
+    def assign(self, targets, candidates=None):
+        """
+        same as solve_assignment, reading the features block by block each time candidates are read
+        """
+        targets = np.asarray(targets)
+        if len(targets) > int(self.available.sum()):
+            raise ValueError('Not enough pictures to match without repeat: {} < {}'.format(
+                int(self.available.sum()), len(targets)))
+        assigned = auction(targets, self.candidates, len(self.features), candidates)
+        self.available[assigned[assigned != -1]] = False
+        return self._fill(targets, assigned)
+
+    def _fill(self, targets, assigned):
+        """
+        give targets not assigned yet the closest available feature, in order, one pass over the features each time,
+        a pass stops at the first target whose candidates were all taken by targets before it,
+        the next pass reads twice as many candidates, so passes grow with the log of the number of targets
+        """
+        left = np.flatnonzero(assigned == -1)
+        k = settings.ASSIGNMENT_CANDIDATES
+        while len(left):
+            available = int(self.available.sum())
+            if not available:
+                raise ValueError('Not enough pictures to match without repeat')
+            # candidates of all targets left are held at once, (B, k) indices and costs within memory_budget
+            k = max(1, min(k, available, max(settings.ASSIGNMENT_CANDIDATES, self.memory_budget // (16 * len(left)))))
+            indices, _ = self.candidates(targets[left], k)
+            for target_index, target_candidates in zip(left, indices):
+                free = (target_candidates != -1) & self.available[target_candidates]
+                first = int(free.argmax())
+                if not free[first]:
+                    break
+                self.available[target_candidates[first]] = False
+                assigned[target_index] = target_candidates[first]
+            left = np.flatnonzero(assigned == -1)
+            k *= 2
+        return assigned
+
+
+class KDTree(object):
+    """
+    KD-tree over feature vectors, answers nearest neighbour queries and supports removal of points,
+    removed points are only marked and skipped, subtrees with no points left are pruned
+
+    Variables:
+        self.points
+        self.alive
+        self.order
+        self.lower, self.upper  # bounding box of each node
+        self.left, self.right  # children of each node, -1 if leaf
+        self.parent
+        self.start, self.end  # each node covers self.order[start:end]
+        self.counts  # points left in each node
+        self.leaf_of  # leaf node of each point
+        self.point_counts  # number of times each point can still be matched without repeat
+    """
+
+    def __init__(self, points, leaf_size=None, point_counts=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+        self.leaf_size = leaf_size or settings.KD_TREE_LEAF_SIZE
+        total = len(self.points)
+        self.point_counts = np.ones(total, dtype=np.int64) if point_counts is None else np.array(point_counts)
+        self.alive = np.ones(total, dtype=bool)
+        self.order = np.arange(total)
+        self.leaf_of = np.zeros(total, dtype=np.int64)
+
+        lower, upper, left, right, parent, start, end = [], [], [], [], [], [], []
+        stack = [(0, total, -1, None)]
+        while stack:
+            node_start, node_end, node_parent, side = stack.pop()
+            node = len(start)
+            if side is not None:
+                (left if side == 0 else right)[node_parent] = node
+            indices = self.order[node_start:node_end]
+            node_points = self.points[indices]
+            if len(node_points):
+                lower.append(node_points.min(axis=0))
+                upper.append(node_points.max(axis=0))
+            else:
+                lower.append(np.full(self.points.shape[1], np.inf))
+                upper.append(np.full(self.points.shape[1], -np.inf))
+            left.append(-1)
+            right.append(-1)
+            parent.append(node_parent)
+            start.append(node_start)
+            end.append(node_end)
+
+            if node_end - node_start <= self.leaf_size:
+                self.leaf_of[indices] = node
+                continue
+
+            dim = int(np.argmax(upper[node] - lower[node]))
+            middle = (node_end - node_start) // 2
+            partition = np.argpartition(node_points[:, dim], middle)
+            self.order[node_start:node_end] = indices[partition]
+            stack.append((node_start + middle, node_end, node, 1))
+            stack.append((node_start, node_start + middle, node, 0))
+
+        self.lower = np.array(lower).reshape(len(start), -1)
+        self.upper = np.array(upper).reshape(len(start), -1)
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.parent = np.array(parent, dtype=np.int64)
+        self.start = np.array(start, dtype=np.int64)
+        self.end = np.array(end, dtype=np.int64)
+        self.counts = self.end - self.start
+        for index in np.flatnonzero(self.point_counts <= 0):
+            self.remove(index)
+
+    def __len__(self):
+        return int(self.counts[0]) if len(self.counts) else 0
+
+    def _box_dist(self, node, point):
+        diff = np.maximum(np.maximum(self.lower[node] - point, point - self.upper[node]), 0)
+        return float(np.dot(diff, diff))
+
+    def query(self, point):
+        """
+        :param point: feature vector
+        :return: (index, squared distance) of the closest point that is not removed
+        """
+        point = np.asarray(point, dtype=np.float64)
+        best_dist = np.inf
+        best_index = -1
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_dist or self.counts[node] == 0:
+                continue
+            if self.left[node] == -1:
+                indices = self.order[self.start[node]:self.end[node]]
+                indices = indices[self.alive[indices]]
+                diff = self.points[indices] - point
+                dist = np.einsum('ij,ij->i', diff, diff)
+                nearest = int(np.argmin(dist))
+                if dist[nearest] < best_dist:
+                    best_dist = float(dist[nearest])
+                    best_index = int(indices[nearest])
+                continue
+            left, right = self.left[node], self.right[node]
+            left_bound, right_bound = self._box_dist(left, point), self._box_dist(right, point)
+            # visit nearer child first
+            if left_bound <= right_bound:
+                stack.append((right, right_bound))
+                stack.append((left, left_bound))
+            else:
+                stack.append((left, left_bound))
+                stack.append((right, right_bound))
+        if best_index == -1:
+            raise ValueError('Not enough pictures to match without repeat')
+        return best_index, best_dist
+
+    def take(self, index):
+        """
+        use the point once, it is removed when it cannot be used anymore
+        """
+        self.point_counts[index] -= 1
+        if self.point_counts[index] <= 0:
+            self.remove(index)
+
+    def remove(self, index):
+        if not self.alive[index]:
+            return
+        self.alive[index] = False
+        node = self.leaf_of[index]
+        while node != -1:
+            self.counts[node] -= 1
+            node = self.parent[node]
+
+    def match(self, targets, use_repeat):
+        """
+        same as BatchMatcher.match, targets must be in the same space as the points
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        result = np.empty(len(targets), dtype=np.int64)
+        for target_index, target in enumerate(targets):
+            index, _ = self.query(target)
+            if not use_repeat:
+                self.take(index)
+            result[target_index] = index
+        return result
+
+
+class ColorLookupTable(object):
+    """
+    rgb cube quantized into bins x bins x bins, each bin stores the index of the feature closest to its center,
+    lookups are a single array index. When a feature is removed, bins pointing to it are repaired on next use
+
+    Variables:
+        self.features
+        self.bins
+        self.table  # (bins, bins, bins) array of indices into self.features
+        self.counts  # number of times each feature can still be matched without repeat
+        self.available
+    """
+
+    def __init__(self, features, table, counts=None):
+        self.features = np.asarray(features)
+        self.table = np.array(table, dtype=np.int64)
+        self.bins = self.table.shape[0]
+        self.counts = np.ones(len(self.features), dtype=np.int64) if counts is None else np.array(counts)
+        self.available = self.counts > 0
+
+    @staticmethod
+    def build(features, bins):
+        """
+        :return: (bins, bins, bins) array of the closest feature to the center of each bin
+        """
+        bin_centers = (np.arange(bins) + 0.5) * 256 / bins - 0.5
+        r, g, b = np.meshgrid(bin_centers, bin_centers, bin_centers, indexing='ij')
+        centers = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+        features = np.asarray(features, dtype=np.float64)
+        # |c - f|^2 = |c|^2 - 2 c.f + |f|^2, |c|^2 is the same for every feature of a center
+        norms = np.einsum('ij,ij->i', features, features)
+        table = np.empty(len(centers), dtype=np.int64)
+        # a (batch, N) product and about two temporaries of the same size for each batch of centers
+        batch_size = max(1, settings.MATCH_MEMORY_BUDGET // (len(features) * 8 * 3))
+        for start in range(0, len(centers), batch_size):
+            block = centers[start:start + batch_size]
+            table[start:start + len(block)] = np.argmin(norms[None, :] - 2 * (block @ features.T), axis=1)
+        return table.reshape(bins, bins, bins)
+
+    def get_bins(self, targets):
+        return np.clip(np.asarray(targets, dtype=np.int64) * self.bins // 256, 0, self.bins - 1)
+
+    def _repair(self, r, g, b):
+        center = (np.array([r, g, b]) + 0.5) * 256 / self.bins - 0.5
+        dist = euclidean_dist(center[None, :], self.features.astype(np.float64))[0]
+        dist[~self.available] = np.inf
+        self.table[r, g, b] = int(np.argmin(dist))
+
+    def match(self, targets, use_repeat):
+        """
+        same as BatchMatcher.match, each target gets the feature stored in its bin
+        """
+        bins = self.get_bins(targets)
+        if use_repeat:
+            return self.table[bins[:, 0], bins[:, 1], bins[:, 2]]
+        result = np.empty(len(bins), dtype=np.int64)
+        for target_index, (r, g, b) in enumerate(bins.tolist()):
+            if not self.available[self.table[r, g, b]]:
+                if not self.available.any():
+                    raise ValueError('Not enough pictures to match without repeat')
+                self._repair(r, g, b)
+            index = int(self.table[r, g, b])
+            self.counts[index] -= 1
+            self.available[index] = self.counts[index] > 0
+            result[target_index] = index
+        return result
+
+
+class ColorIndex(object):
+    """
+    all tiles grouped by their exact average color (or descriptor), tiles sharing a color are all kept and
+    handed out one by one in no repeat mode
+
+    Variables:
+        self.colors  # (U, D) distinct colors, in order of their first tile
+        self.counts  # (U,) number of tiles of each color
+        self.offsets  # tiles of color c are self.tiles[offsets[c]:offsets[c + 1]]
+        self.tiles  # (N,) tile ids grouped by color
+        self.used  # (U,) number of tiles of each color taken
+    """
+
+    def __init__(self, features):
+        features = np.asarray(features).reshape(len(features), -1)
+        unique, first, inverse, counts = np.unique(features, axis=0, return_index=True, return_inverse=True,
+                                                   return_counts=True)
+        order = np.argsort(first, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.colors = unique[order]
+        self.counts = counts[order]
+        self.tiles = np.argsort(rank[inverse.reshape(-1)], kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.used = np.zeros(len(self.colors), dtype=np.int64)
+
+    def __len__(self):
+        """
+        :return: number of tiles not taken yet
+        """
+        return int(len(self.tiles) - self.used.sum())
+
+    def left(self):
+        return self.counts - self.used
+
+    def first_tiles(self, colors):
+        return self.tiles[self.offsets[np.asarray(colors, dtype=np.int64)]]
+
+    def take(self, color):
+        if self.used[color] >= self.counts[color]:
+            raise ValueError('Not enough pictures to match without repeat')
+        tile = self.tiles[self.offsets[color] + self.used[color]]
+        self.used[color] += 1
+        return int(tile)
+
+    def reserve(self, tiles):
+        """
+        take the given tiles, so they are not handed out again
+        :param tiles: tile ids not taken yet
+        """
+        positions = np.empty(len(self.tiles), dtype=np.int64)
+        positions[self.tiles] = np.arange(len(self.tiles))
+        for tile in np.asarray(tiles, dtype=np.int64).tolist():
+            position = positions[tile]
+            color = int(np.searchsorted(self.offsets, position, side='right')) - 1
+            free = self.offsets[color] + self.used[color]
+            if position < free:
+                raise ValueError('Tile is already taken: {}'.format(tile))
+            # move the tile to the front of the tiles of its color not taken yet
+            other = self.tiles[free]
+            self.tiles[free], self.tiles[position] = tile, other
+            positions[tile], positions[other] = free, position
+            self.used[color] += 1
+
+    def to_tiles(self, colors, use_repeat):
+        """
+        :param colors: indices into self.colors, as returned by matchers
+        :return: tile ids, without repeat each color hands out its next unused tile
+        """
+        if use_repeat:
+            return self.first_tiles(colors)
+        return np.array([self.take(color) for color in np.asarray(colors).tolist()], dtype=np.int64)
+
+
+class PCA(object):
+    """
+    principal component analysis, reduces descriptors to their few most varying directions
+
+    Variables:
+        self.mean  # (D,)
+        self.components  # (k, D) orthonormal, most varying first
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+
+    @staticmethod
+    def fit(samples, k):
+        """
+        :param samples: (N, D) array, read block by block so it can be memory mapped
+        :param k: number of components kept, at most D
+        """
+        block_size = settings.MAX_CACHE_PROCESSED_IMAGES
+        dimension = samples.shape[1]
+        total = np.zeros(dimension)
+        scatter = np.zeros((dimension, dimension))
+        for start in range(0, len(samples), block_size):
+            block = np.asarray(samples[start:start + block_size], dtype=np.float64)
+            total += block.sum(axis=0)
+            scatter += block.T @ block
+        mean = total / max(len(samples), 1)
+        covariance = scatter / max(len(samples), 1) - np.outer(mean, mean)
+        _, vectors = np.linalg.eigh(covariance)
+        return PCA(mean, vectors[:, ::-1][:, :k].T)
+
+    def transform(self, samples):
+        """
+        :return: (N, k) array of samples in the reduced space
+        """
+        result = np.empty((len(samples), len(self.components)))
+        block_size = settings.MAX_CACHE_PROCESSED_IMAGES
+        for start in range(0, len(samples), block_size):
+            block = np.asarray(samples[start:start + block_size], dtype=np.float64)
+            result[start:start + len(block)] = (block - self.mean) @ self.components.T
+        return result
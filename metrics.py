@@ -0,0 +1,152 @@
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import settings
+
+
+class Metrics(object):
+    """
+    time spent in each stage of a run and counters, safe to record from several threads
+
+    Variables:
+        self.stages  # name -> [seconds, calls, items], seconds of stages run in workers are summed over workers
+        self.counters  # name -> value
+        self.start_time
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, items=0):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0.0, 0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+            stage[2] += items
+
+    @contextmanager
+    def stage(self, name, items=0):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time, items)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'seconds': time.time() - self.start_time,
+                'stages': {name: {'seconds': seconds, 'calls': calls, 'items': items,
+                                  'rate': items / seconds if items and seconds else None}
+                           for name, (seconds, calls, items) in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+
+    def save(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def print_summary(self):
+        report = self.to_dict()
+        print('{:<16}{:>10}{:>8}{:>10}{:>14}'.format('stage', 'seconds', 'calls', 'items', 'items/s'))
+        for name, stage in report['stages'].items():
+            print('{:<16}{:>10.2f}{:>8}{:>10}{:>14}'.format(
+                name, stage['seconds'], stage['calls'], stage['items'],
+                '-' if stage['rate'] is None else '{:.1f}'.format(stage['rate'])))
+        for name, value in report['counters'].items():
+            print('{:<16}{:>10}'.format(name, value))
+
+
+# metrics of the run, a thread records into its own Metrics instead within collect()
+default = Metrics()
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, 'metrics', None) or default
+
+
+@contextmanager
+def collect():
+    """
+    record into a new Metrics within the block, in this thread only,
+    pass current() to threads started within the block to record into it too
+    :return: the new Metrics
+    """
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = Metrics()
+    try:
+        yield _local.metrics
+    finally:
+        _local.metrics = previous
+
+
+def stage(name, items=0):
+    return current().stage(name, items)
+
+
+def add(name, seconds, items=0):
+    current().add(name, seconds, items)
+
+
+def count(name, value=1):
+    current().count(name, value)
+
+
+@contextmanager
+def profile(filename=None):
+    """
+    run the block under cProfile, saving stats to filename or printing the slowest calls
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if filename:
+            profiler.dump_stats(filename)
+            print('Profile saved to {}'.format(filename))
+        else:
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(20)
+
+
+class Progress(object):
+    """
+    progress line of a loop, redrawn at most every PROGRESS_INTERVAL seconds
+
+    Variables:
+        self.total
+        self.start_time
+        self.last_render  # time the line was last drawn
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.start_time = time.perf_counter()
+        self.last_render = None
+
+    def update(self, curr):
+        interval = settings.PROGRESS_INTERVAL
+        if interval is None:
+            return
+        now = time.perf_counter()
+        if curr < self.total and self.last_render is not None and now - self.last_render < interval:
+            return
+        self.last_render = now
+        elapsed = now - self.start_time
+        time_left = elapsed / curr * (self.total - curr) if curr else float('inf')
+        print('\r >>> {0} / {1} => {2}% | Time Left est. {3:.2f}s'.format(
+            curr, self.total, curr * 100 // max(self.total, 1), time_left), end='')
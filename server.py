@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import main
+import metrics
+import settings
+from items import ImageDatabase
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+
+class Job(object):
+    """
+    one mosaic to make, see MosaicService.submit for its options
+
+    Variables:
+        self.id
+        self.options
+        self.status  # 'queued', 'running', 'done' or 'failed'
+        self.outputs  # files saved
+        self.metrics  # time spent in each stage, see metrics.Metrics.to_dict
+        self.error
+        self.finished  # set when done or failed
+    """
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.status = 'queued'
+        self.outputs = []
+        self.metrics = None
+        self.error = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.finish_time = None
+        self.finished = threading.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'options': self.options,
+            'status': self.status,
+            'outputs': self.outputs,
+            'metrics': self.metrics,
+            'error': self.error,
+            'queued_seconds': (self.start_time or time.time()) - self.submit_time,
+            'seconds': None if self.start_time is None else (self.finish_time or time.time()) - self.start_time,
+        }
+
+
+class MosaicService(object):
+    """
+    keeps databases of one folder loaded, one for each piece size, and makes mosaics from them in a pool of threads
+
+    Variables:
+        self.folder  # folder of images of the database
+        self.dest  # each job saves into a folder named by its id here, unless given
+        self.databases  # size -> loaded ImageDatabase
+        self.jobs  # id -> Job, in order of submission, only the last SERVER_JOBS_KEPT finished jobs are kept
+        self.executor
+    """
+
+    def __init__(self, folder, dest, workers=None):
+        self.folder = folder
+        self.dest = dest
+        self.databases = dict()
+        self.jobs = dict()
+        self.executor = ThreadPoolExecutor(max_workers=workers or settings.SERVER_WORKERS or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def get_database(self, size):
+        """
+        :return: database of size, loaded or created on first use
+        """
+        database = self.databases.get(size)
+        if database is not None:
+            return database
+        with self._load_lock:
+            if size not in self.databases:
+                self.databases[size] = main._load_database(self.folder, size, True, 0)
+            return self.databases[size]
+
+    def submit(self, options):
+        """
+        :param options: dict of
+            source: the image to stimulate
+            size: the size of each pieces
+            factor: result size factor compared to original, default 1
+            repeat: allow build with repeating images, default False
+            method: color difference method, default COLOR_DIFF_METHOD
+            dest: folder to save to, default a new folder in self.dest
+            blend, format, quality: see main.py
+        :return: Job, queued
+        """
+        if not options.get('source') or not options.get('size'):
+            raise ValueError('source and size are required')
+        try:
+            size = int(options['size'])
+        except (TypeError, ValueError):
+            raise ValueError('size must be an integer: {}'.format(options['size']))
+        if size < 1:
+            raise ValueError('size must be at least 1: {}'.format(options['size']))
+        # same default as main.run_job
+        method = options.get('method') or settings.COLOR_DIFF_METHOD
+        if not isinstance(method, str) or method not in ImageDatabase.methods:
+            raise ValueError('Unknown color difference method: {}'.format(method))
+        job = Job(options)
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other.finished.is_set()]
+            for job_id in finished[:max(0, len(finished) - settings.SERVER_JOBS_KEPT)]:
+                del self.jobs[job_id]
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job):
+        job.status = 'running'
+        job.start_time = time.time()
+        options = job.options
+        with metrics.collect() as recorder:
+            try:
+                database = self.get_database(int(options['size']))
+                job.outputs = main.run_job(database, options, os.path.join(self.dest, job.id))
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = '{}: {}'.format(type(e).__name__, e)
+                job.status = 'failed'
+            finally:
+                job.metrics = recorder.to_dict()
+                job.finish_time = time.time()
+                job.finished.set()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs with json options of MosaicService.submit, add "wait": true to respond when finished
+    GET /jobs/<id> status, outputs and metrics of a job
+    GET /health
+    """
+    service = None
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            return self._respond(200, {'status': 'ok', 'sizes loaded': sorted(self.service.databases)})
+        if self.path.startswith('/jobs/'):
+            job = self.service.get(self.path[len('/jobs/'):])
+            if job is None:
+                return self._respond(404, {'error': 'No such job'})
+            return self._respond(200, job.to_dict())
+        return self._respond(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._respond(404, {'error': 'Not found'})
+        try:
+            options = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(options, dict):
+                raise ValueError('Options must be a json object')
+            wait = options.pop('wait', False)
+            job = self.service.submit(options)
+        except ValueError as e:
+            return self._respond(400, {'error': str(e)})
+        if wait:
+            job.finished.wait()
+        return self._respond(200 if job.finished.is_set() else 202, job.to_dict())
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'local'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host=None, port=None, unix_socket=None):
+    RequestHandler.service = service
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+        print('Serving on {}'.format(unix_socket))
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        print('Serving on http://{}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def main_server():
+    parser = argparse.ArgumentParser(description='serve mosaic jobs keeping the database loaded')
+    parser.add_argument('-f', '--folder', required=True, help='the folder containing images used to stimulate sources')
+    parser.add_argument('-d', '--dest', default='output', help='folder to save the output of each job in')
+    parser.add_argument('-s', '--size', type=int, nargs='*', default=[], help='sizes of pieces to load at start')
+    parser.add_argument('-w', '--workers', type=int, help='number of jobs run at once, default SERVER_WORKERS')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-u', '--unix-socket', help='listen on this unix socket instead of host and port')
+    args = parser.parse_args()
+
+    service = MosaicService(args.folder, args.dest, args.workers)
+    for size in args.size:
+        service.get_database(size)
+    serve(service, args.host, args.port, args.unix_socket)
+
+
+if __name__ == '__main__':
+    main_server()
@@ -3,25 +3,92 @@
 
 
 
-ALLOW_USE_EXISING_IF_SEEM_SAME = True
+ALLOW_USE_EXISING_IF_SEEM_SAME = True  # trust images of a database without manifest if their filenames are unchanged
+
+MANIFEST_HASH = False  # also store content hash of images, so touched but unchanged images are not decoded again
 
 MAX_CHUNKS_USE = None  # or (int) number of chunks to use, each chunk is same as MAX_CACHE_PROCESSED_IMAGES
 
+# bytes used for scoring chunks against the database, bigger databases are matched by reading features from disk
+# block by block instead of holding them in memory, so all images can be used without MAX_CHUNKS_USE
+MATCH_MEMORY_BUDGET = 512 * 1024 * 1024
+
 COLOR_DIFF_METHOD = 'euclidean'
 """
-'color space'  # very fast but not accurate
+'color space'  # very fast, nearest picture of each bin of COLOR_SPACE_BINS, accurate up to the bin size
 'euclidean'  # classic euclidean algorithm
 'euclidean optimized'  # slightly better than euclidean but much slower
+'kd tree'  # nearest color by kd tree, fast for big database and when repeat is not allowed
+'cie76'  # euclidean in Lab color space
+'cie94'  # perceptual, weights chroma and hue differences
+'ciede2000'  # most accurate perceptual difference, slowest, reduce MATCH_BATCH_SIZE if memory is tight
+'cmc'  # perceptual, see CMC_L and CMC_C
+"""
+CMC_L = 2  # lightness weight of 'cmc', 2 for acceptability, 1 for imperceptibility
+CMC_C = 1  # chroma weight of 'cmc'
+MATCH_BATCH_SIZE = 128  # number of chunks scored against the whole database at once, bounds memory used
+
+KD_TREE_COLOR_SPACE = 'rgb'  # or 'lab', the space the kd tree search nearest color in
+KD_TREE_LEAF_SIZE = 16  # number of images in each leaf of the kd tree
+
+NO_REPEAT_ASSIGNMENT = 'greedy'
+"""
+'greedy'  # match chunks in order, earlier chunks take the best pictures
+'global'  # match all chunks at once for a lower total difference, trades speed for quality, it is not faster than
+# 'greedy': about as fast for varied sources, several times slower for flat ones, for a few % lower total difference
+"""
+ASSIGNMENT_CANDIDATES = 16  # number of closest pictures each chunk considers in 'global' assignment
+ASSIGNMENT_EPSILON = 1e-2  # minimum bid increment in 'global' assignment, relative to the range of differences,
+# smaller is more accurate but slower
+ASSIGNMENT_MAX_ROUNDS = 10000  # chunks still bidding after this many rounds take the closest pictures left, in order
+
+DESCRIPTOR_GRID = None  # or (int) match by average colors of grid x grid cells of each piece instead of one color
+DESCRIPTOR_LAB = False  # take cells in Lab, so differences are closer to perceived ones
+DESCRIPTOR_COMPONENTS = 6  # cells are reduced to this many numbers by PCA, keeping matching about as fast as colors
+# with DESCRIPTOR_GRID, every COLOR_DIFF_METHOD is euclidean in the reduced space, except 'kd tree' searches it
 
-# not implemented yet
-'cie76'
-'cie94'
-'ciede2000'
-'cmc'
+BUILD_WORKERS = None  # number of processes or threads decoding images when creating database, None to use all cores
+BUILD_PIPELINE = 'threads'
 """
+'threads'  # READ_WORKERS threads read files ahead into a queue, BUILD_WORKERS threads decode them
+'processes'  # BUILD_WORKERS processes each read and decode their files
+"""
+READ_WORKERS = 4  # threads reading files in 'threads' pipeline, more helps on network drives
+DECODE_QUEUE_SIZE = 64  # files read or decoded but not written yet in 'threads' pipeline, bounds memory used
+
+ENCODE_WORKERS = None  # number of threads blending and saving output images, None to use all cores
+STREAM_STRIP_ROWS = 8  # rows of pieces made and written at a time with --stream, memory used grows with it
+PNG_COMPRESS_LEVEL = 6  # zlib level of png written with --stream, 1 is fastest, 9 is smallest
+
+BATCH_WORKERS = None  # number of processes running jobs of a --batch file, None to use all cores
+
+SERVER_WORKERS = 2  # number of mosaics server.py makes at once, each holds its output images in memory
+SERVER_JOBS_KEPT = 1000  # finished jobs server.py keeps to answer GET /jobs/<id>, older ones are forgotten
+
+VIDEO_CHANGE_THRESHOLD = 8  # video.py matches a chunk again when its average r, g or b moved more than this
+
+PREVIEW_GRID = 4  # preview matches chunks of PREVIEW_GRID x PREVIEW_GRID pieces
+PREVIEW_TILE_SIZE = 8  # size of each chunk in previews, the closest of DATABASE_IMAGE_SIZES is used
+PREVIEW_REUSE_THRESHOLD = 8  # pieces keep the image of their preview chunk if their average r, g, b are this close
+
+COLOR_SPACE_BINS = 32  # 'color space' divides each of r, g, b into this many bins, 64 is more accurate but slower to build
+
+SHARED_TILE_CACHE = None  # or folder keeping tiles of all databases by content, images seen before are not decoded
+SHARED_TILE_CACHE_SIZE = 8 * 1024 * 1024 * 1024  # bytes, least recently used images are evicted beyond this
+
+MEMORY_MAP_TILES = True  # False reads only selected tiles from disk, memory used is then mostly TILE_CACHE_SIZE
+TILE_CACHE_SIZE = 4096  # number of resized tiles kept in memory for compositing
+
+PROGRESS_INTERVAL = 0.2  # seconds between redrawing progress lines, None to hide them
+
 # XXX if change variables below, it may re-create your database
 
-IMAGES_FOLDER = 'images'
+IMAGES_FOLDER = 'images'  # old pickled database, migrated to TILES_FILE when found
+TILES_FILE = 'tiles'
+FEATURES_FILE = 'features'
+MANIFEST_FILE = 'manifest'
+COLOR_SPACE_FILE = 'color_space'
+DESCRIPTORS_FILE = 'descriptors'
 DATABASE_FILE = 'database'
 POSTFIX = 'data'
 
@@ -29,5 +96,4 @@ DATABASE_FOLDER = '{folder}.' + POSTFIX
 
 MAX_CACHE_PROCESSED_IMAGES = 2000
 
-DATABASE_IMAGE_HEIGHT = 100
-DATABASE_IMAGE_WIDTH = 100
+DATABASE_IMAGE_SIZES = (8, 16, 32, 64, 100, 200)  # sizes of images stored, each run uses the closest size
@@ -1,13 +1,23 @@
-import math
+import hashlib
+import io
 import pickle
 import re
 import os
 import time
 from multiprocessing import current_process, Process
-from threading import Thread
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread, get_ident
 from glob import glob
 import shutil
+import struct
+import zlib
+from collections import OrderedDict
 
+import numpy as np
+from PIL import Image
+
+import colors
+import metrics
 import settings
 
 
@@ -31,15 +41,32 @@ class DatabaseStructure(object):
     """
     Variables:
         self.folder
-        self.image_folder
-        self.database_file
+        self.image_folder  # legacy pickled chunks
+        self.tiles_file  # (N, size, size, 3) uint8 array of all images, one file for each size
+        self.features_file  # filenames of the images in tiles files
+        self.level_features_file  # (N, 3) average colors of the images, one file for each size
+        self.level_lab_file  # (N, 3) average colors in Lab, one file for each size
+        self.manifest_file  # filename -> (size, mtime, hash, row in tiles files)
+        self.color_space_file  # cached color lookup tables
+        self.descriptors_file  # cached (N, grid * grid * 3) average colors of cells of the images, see DESCRIPTOR_GRID
+        self.shared  # SharedTileCache holding the tiles instead of tiles_file, see SHARED_TILE_CACHE
+        self.levels  # tile sizes stored
         self.postfix
     """
 
     def __init__(self, folder):
         self.folder = clean_filename(settings.DATABASE_FOLDER.format(folder=folder))
         self.image_folder = self.folder + '/' + clean_filename(settings.IMAGES_FOLDER)
+        self.tiles_file = self.folder + '/' + clean_filename(settings.TILES_FILE) + '_{}.npy'
+        self.features_file = self.folder + '/' + clean_filename(settings.FEATURES_FILE) + '.npz'
+        self.level_features_file = self.folder + '/' + clean_filename(settings.FEATURES_FILE) + '_{}.npy'
+        self.level_lab_file = self.folder + '/' + clean_filename(settings.FEATURES_FILE) + '_lab_{}.npy'
+        self.manifest_file = self.folder + '/' + clean_filename(settings.MANIFEST_FILE) + '.' + settings.POSTFIX
+        self.color_space_file = self.folder + '/' + clean_filename(settings.COLOR_SPACE_FILE) + '_{}_{}_{}.npy'
+        self.descriptors_file = self.folder + '/' + clean_filename(settings.DESCRIPTORS_FILE) + '_{}_{}_{}.npy'
         self.postfix = settings.POSTFIX
+        self.levels = sorted(settings.DATABASE_IMAGE_SIZES)
+        self.shared = SharedTileCache(settings.SHARED_TILE_CACHE, self.levels) if settings.SHARED_TILE_CACHE else None
 
     def get_image_filename(self, image_name):
         return (self.image_folder + '/{}.' + self.postfix).format(clean_filename(image_name))
@@ -47,8 +74,6 @@ class DatabaseStructure(object):
     def make_folders(self):
         if not os.path.isdir(self.folder):
             os.mkdir(self.folder)
-        if not os.path.isdir(self.image_folder):
-            os.mkdir(self.image_folder)
 
     def get_list_name(self, number):
         return (self.image_folder + '/{}.' + self.postfix).format(number)
@@ -60,59 +85,631 @@ class DatabaseStructure(object):
         if os.path.isdir(self.folder):
             shutil.rmtree(self.folder)
 
+    def get_tiles_filename(self, level):
+        return self.tiles_file.format(level)
+
+    def get_level(self, size):
+        """
+        :return: the smallest stored tile size not smaller than size, or the largest one
+        """
+        for level in self.levels:
+            if level >= size:
+                return level
+        return self.levels[-1]
+
+    def has_tile_store(self):
+        if self.shared is not None:
+            return self.load_hashes() is not None
+        return all(os.path.isfile(self.get_tiles_filename(level)) for level in self.levels) \
+               and os.path.isfile(self.features_file)
+
+    def has_legacy_chunks(self):
+        return os.path.isdir(self.image_folder) and bool(self.get_list_names())
+
+    def create_tiles(self, count, level, temporary=False):
+        """
+        :param temporary: write beside the existing tiles, call commit_tiles to replace them
+        :return: writable memory mapped (count, level, level, 3) array, flush it after writing
+        """
+        if not os.path.isdir(self.folder):
+            os.mkdir(self.folder)
+        filename = self.get_tiles_filename(level)
+        if temporary:
+            filename += '.tmp'
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=(count, level, level, 3))
+
+    def extend_tiles(self, count, level):
+        """
+        grow the tile store of level to count tiles in place, its tiles are kept and rows after them are zeros
+        :return: writable memory mapped (count, level, level, 3) array, flush it after writing,
+                 or None if the header of the file has no room for the new count
+        """
+        filename = self.get_tiles_filename(level)
+        with open(filename, 'r+b') as file:
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                read_header, write_header = np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0
+            elif version == (2, 0):
+                read_header, write_header = np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0
+            else:
+                return None
+            _, fortran_order, dtype = read_header(file)
+            offset = file.tell()
+            # npy headers are padded so the first dimension can grow without moving the data
+            header = io.BytesIO()
+            write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                                  'shape': (count, level, level, 3)})
+            if fortran_order or len(header.getvalue()) != offset:
+                return None
+            file.truncate(offset + count * level * level * 3 * dtype.itemsize)
+            file.seek(0)
+            file.write(header.getvalue())
+        return np.load(filename, mmap_mode='r+')
+
+    def commit_tiles(self, level):
+        os.replace(self.get_tiles_filename(level) + '.tmp', self.get_tiles_filename(level))
+
+    def load_tiles(self, level):
+        """
+        :return: read only memory mapped (N, level, level, 3) array, pixels are only read from disk when used,
+                 or CachedTiles with SHARED_TILE_CACHE
+        """
+        if self.shared is not None:
+            return self.load_cached_tiles(level)
+        return np.load(self.get_tiles_filename(level), mmap_mode='r')
+
+    def load_cached_tiles(self, level):
+        hashes = self.load_hashes()
+        if hashes is None:
+            raise ValueError('Tiles of {} are not in the shared tile cache'.format(self.folder))
+        slots = self.shared.lookup(hashes)
+        if (slots == -1).any():
+            raise ValueError('{} images of {} were evicted from the shared tile cache'.format(
+                int((slots == -1).sum()), self.folder))
+        return CachedTiles(self.shared.open_tiles(level), slots)
+
+    def open_tiles(self, level):
+        """
+        :return: tiles of level for reading selected tiles, memory mapped or TileReader, see MEMORY_MAP_TILES
+        """
+        if self.shared is not None:
+            return self.load_cached_tiles(level)
+        if settings.MEMORY_MAP_TILES:
+            return self.load_tiles(level)
+        return TileReader(self.get_tiles_filename(level))
+
+    def save_features(self, features, lab, filenames, hashes=None):
+        """
+        :param features: level -> (N, 3) array of average colors
+        :param lab: level -> (N, 3) array of average colors in Lab
+        :param hashes: content hashes of the images, their tiles are in the shared tile cache
+        """
+        for level in self.levels:
+            np.save(self.level_features_file.format(level), np.asarray(features[level], dtype=np.int64))
+            np.save(self.level_lab_file.format(level), np.asarray(lab[level], dtype=np.float64))
+        with open(self.features_file, 'wb') as file:
+            if hashes is None:
+                np.savez(file, filenames=np.array(filenames, dtype=str))
+            else:
+                np.savez(file, filenames=np.array(filenames, dtype=str), hashes=np.array(hashes, dtype=str))
+
+    def load_hashes(self):
+        """
+        :return: list of content hashes of the images, or None if tiles are not in the shared tile cache
+        """
+        if not os.path.isfile(self.features_file):
+            return None
+        with np.load(self.features_file) as data:
+            return data['hashes'].tolist() if 'hashes' in data else None
+
+    def load_features(self, mmap=False):
+        """
+        :param mmap: memory map features instead of reading them, for databases too big to hold in memory
+        :return: level -> (N, 3) array of average colors, level -> (N, 3) array of Lab colors, (N,) array of filenames
+        """
+        with np.load(self.features_file) as data:
+            filenames = data['filenames']
+        mmap_mode = 'r' if mmap else None
+        features = {level: np.load(self.level_features_file.format(level), mmap_mode=mmap_mode)
+                    for level in self.levels}
+        lab = {level: np.load(self.level_lab_file.format(level), mmap_mode=mmap_mode) for level in self.levels}
+        return features, lab, filenames
+
+    def get_color_space_filename(self, level, bins, count):
+        return self.color_space_file.format(level, bins, count)
+
+    def remove_color_spaces(self):
+        for filename in glob(self.color_space_file.format('*', '*', '*')):
+            os.remove(filename)
+
+    def load_descriptors(self, level, grid, space):
+        """
+        descriptors of the tiles of level, computed from the tile store and cached on first use
+        :param space: 'rgb' or 'lab'
+        :return: memory mapped (N, grid * grid * 3) float32 array
+        """
+        filename = self.descriptors_file.format(level, grid, space)
+        if not os.path.isfile(filename):
+            descriptors = tile_descriptors(self.load_tiles(level), grid)
+            if space == 'lab':
+                descriptors = colors.rgb_to_lab(descriptors.reshape(-1, 3)).reshape(len(descriptors), -1)
+            save_array(filename, descriptors.astype(np.float32))
+        return np.load(filename, mmap_mode='r')
+
+    def remove_descriptors(self):
+        for filename in glob(self.descriptors_file.format('*', '*', '*')):
+            os.remove(filename)
+
+    def save_manifest(self, manifest):
+        with open(self.manifest_file, 'wb') as file:
+            pickle.dump(manifest, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_manifest(self):
+        """
+        :return: filename -> (size, mtime, hash, row in tiles_file), or None if there is no manifest
+        """
+        if not os.path.isfile(self.manifest_file):
+            return None
+        return load(self.manifest_file)
+
+    def migrate_legacy_chunks(self):
+        """
+        convert pickled chunks of DatabaseImageItem to the tile store, then remove them
+        """
+        chunks = self.get_list_names()
+        print('Migrating {} chunks from {}'.format(len(chunks), self.image_folder))
+        start_time = time.time()
+        progress = metrics.Progress(len(chunks))
+        items = []
+        for index, chunk in enumerate(chunks):
+            items += load(chunk)
+            progress.update(index + 1)
+        features = dict()
+        for level in self.levels:
+            tiles = self.create_tiles(len(items), level)
+            for index, item in enumerate(items):
+                tiles[index] = image_to_tile(item.big_image, level)
+            tiles.flush()
+            features[level] = tile_features(tiles)
+            del tiles
+        lab = {level: colors.rgb_to_lab(level_features) for level, level_features in features.items()}
+        self.save_features(features, lab, [item.filename for item in items])
+        shutil.rmtree(self.image_folder)
+        print_done(time.time() - start_time)
+
+
+class SharedTileCache(object):
+    """
+    tiles of images of databases of all folders, stored once by content hash of the image,
+    least recently used images are evicted when over SHARED_TILE_CACHE_SIZE bytes,
+    only one process should build databases at a time
+
+    Variables:
+        self.folder
+        self.levels  # tile sizes stored
+        self.max_slots  # number of images fitting in SHARED_TILE_CACHE_SIZE
+        self.tiles_file  # (capacity, size, size, 3) uint8 array of tiles in slots, one file for each size
+        self.index_file  # hash and last used time of each slot
+        self.hashes  # (capacity,) hash of the image in each slot, '' if free
+        self.last_used  # (capacity,) time each slot was last used
+    """
+
+    def __init__(self, folder, levels):
+        self.folder = folder
+        self.levels = levels
+        self.max_slots = settings.SHARED_TILE_CACHE_SIZE // sum(level * level * 3 for level in levels)
+        self.tiles_file = self.folder + '/' + clean_filename(settings.TILES_FILE) + '_{}.npy'
+        self.index_file = self.folder + '/index.npz'
+        self.hashes = None
+        self.last_used = None
+        self._slots = None
+
+    def _load(self):
+        if self.hashes is not None:
+            return
+        if os.path.isfile(self.index_file):
+            with np.load(self.index_file) as data:
+                self.hashes = data['hashes'].astype(object)
+                self.last_used = data['last_used']
+        else:
+            self.hashes = np.array([], dtype=object)
+            self.last_used = np.array([], dtype=np.float64)
+        self._slots = {file_hash: slot for slot, file_hash in enumerate(self.hashes.tolist()) if file_hash}
+
+    def save(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        with open(self.index_file + '.tmp', 'wb') as file:
+            np.savez(file, hashes=self.hashes.astype(str), last_used=self.last_used)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    @property
+    def capacity(self):
+        self._load()
+        return len(self.hashes)
+
+    def lookup(self, hashes):
+        """
+        :return: (len(hashes),) array of slots of the images, -1 for images not in the cache
+        """
+        self._load()
+        return np.array([self._slots.get(file_hash, -1) for file_hash in hashes], dtype=np.int64)
+
+    def touch(self, slots):
+        self._load()
+        self.last_used[np.asarray(slots, dtype=np.int64)] = time.time()
+
+    def allocate(self, hashes, keep):
+        """
+        give slots to images not in the cache yet, growing the cache or evicting least recently used images
+        :param hashes: hashes of the images to add
+        :param keep: slots that must not be evicted
+        :return: (len(hashes),) array of slots, write the tiles there with open_tiles, then save
+        """
+        self._load()
+        free = np.flatnonzero(self.hashes == '')
+        if len(free) < len(hashes) and self.capacity < self.max_slots:
+            self._grow(min(self.max_slots, max(self.capacity * 2, self.capacity + len(hashes) - len(free))))
+            free = np.flatnonzero(self.hashes == '')
+        if len(free) < len(hashes):
+            candidates = np.setdiff1d(np.flatnonzero(self.hashes != ''), keep)
+            evicted = candidates[np.argsort(self.last_used[candidates], kind='stable')][:len(hashes) - len(free)]
+            if len(free) + len(evicted) < len(hashes):
+                raise ValueError('SHARED_TILE_CACHE_SIZE is too small for {} images'.format(len(keep) + len(hashes)))
+            for slot in evicted.tolist():
+                del self._slots[self.hashes[slot]]
+                self.hashes[slot] = ''
+            # the index on disk must not point at slots about to be overwritten, in case decoding fails
+            self.save()
+            free = np.sort(np.concatenate([free, evicted]))
+        slots = free[:len(hashes)]
+        for slot, file_hash in zip(slots.tolist(), hashes):
+            self.hashes[slot] = file_hash
+            self._slots[file_hash] = slot
+        self.touch(slots)
+        return slots
+
+    def _grow(self, capacity):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        old_capacity = self.capacity
+        for level in self.levels:
+            filename = self.tiles_file.format(level)
+            tiles = np.lib.format.open_memmap(filename + '.tmp', mode='w+', dtype=np.uint8,
+                                              shape=(capacity, level, level, 3))
+            if old_capacity:
+                old_tiles = np.load(filename, mmap_mode='r')
+                for start in range(0, old_capacity, settings.MAX_CACHE_PROCESSED_IMAGES):
+                    end = min(start + settings.MAX_CACHE_PROCESSED_IMAGES, old_capacity)
+                    tiles[start:end] = old_tiles[start:end]
+                del old_tiles
+            tiles.flush()
+            del tiles
+            os.replace(filename + '.tmp', filename)
+        self.hashes = np.concatenate([self.hashes, np.full(capacity - old_capacity, '', dtype=object)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(capacity - old_capacity)])
+
+    def open_tiles(self, level, writable=False):
+        """
+        :return: memory mapped (capacity, level, level, 3) array of the tiles in all slots
+        """
+        return np.load(self.tiles_file.format(level), mmap_mode='r+' if writable else 'r')
+
+
+class CachedTiles(object):
+    """
+    tiles of one database in the shared tile cache, indexed like a tiles array of the database
+
+    Variables:
+        self.tiles  # tiles of all slots of the cache
+        self.slots  # slot of each tile of the database
+    """
+
+    def __init__(self, tiles, slots):
+        self.tiles = tiles
+        self.slots = np.asarray(slots, dtype=np.int64)
+
+    @property
+    def shape(self):
+        return (len(self.slots),) + self.tiles.shape[1:]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, key):
+        return self.tiles[self.slots[key]]
+
+
+class TileReader(object):
+    """
+    reads rows of a .npy tiles file with plain file reads, nothing is kept in memory between reads
+
+    Variables:
+        self.filename
+        self.shape
+        self.dtype
+        self.offset  # where the array data starts in the file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                self.shape, _, self.dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                self.shape, _, self.dtype = np.lib.format.read_array_header_2_0(file)
+            self.offset = file.tell()
+        self.row_size = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = range(*rows.indices(len(self)))
+        single = np.ndim(rows) == 0
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+        result = np.empty((len(rows),) + tuple(self.shape[1:]), dtype=self.dtype)
+        with open(self.filename, 'rb') as file:
+            for position in np.argsort(rows, kind='stable'):  # read in file order
+                file.seek(self.offset + int(rows[position]) * self.row_size)
+                result[position] = np.frombuffer(file.read(self.row_size), dtype=self.dtype).reshape(self.shape[1:])
+        return result[0] if single else result
+
+
+class LRUCache(object):
+    """
+    dict like cache keeping at most maxsize items, least recently used are dropped first, can be shared by threads
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
 
 def get_database_structure(folder):
     return DatabaseStructure(folder)
 
 
-def save(item, filename):
-    if not os.path.isfile(filename):
-        with open(filename, 'wb') as file:
-            pickle.dump(item, file, protocol=pickle.HIGHEST_PROTOCOL)
+def image_to_tile(image, size):
+    image = image.convert('RGB')
+    if image.size != (size, size):
+        image = image.resize((size, size))
+    return np.asarray(image, dtype=np.uint8)
 
 
-def load(filename):
+def tile_features(tiles):
+    """
+    :param tiles: (N, H, W, 3) array
+    :return: (N, 3) integer average colors, same as ImageItem
+    """
+    features = np.empty((len(tiles), 3), dtype=np.int64)
+    for start in range(0, len(tiles), settings.MAX_CACHE_PROCESSED_IMAGES):
+        block = np.asarray(tiles[start:start + settings.MAX_CACHE_PROCESSED_IMAGES])
+        pixels = block.shape[1] * block.shape[2]
+        features[start:start + len(block)] = block.reshape(len(block), -1, 3).sum(axis=1, dtype=np.int64) // pixels
+    return features
+
+
+def tile_descriptors(tiles, grid):
+    """
+    :param tiles: (N, H, W, 3) array
+    :return: (N, grid * grid * 3) float32 average colors of grid x grid cells of each tile, cells in raster order,
+             tiles not divisible by grid are box resampled as ImageItem.get_cell_avg does for chunks
+    """
+    count, height, width = tiles.shape[:3]
+    descriptors = np.empty((count, grid * grid * 3), dtype=np.float32)
+    for start in range(0, count, settings.MAX_CACHE_PROCESSED_IMAGES):
+        block = np.asarray(tiles[start:start + settings.MAX_CACHE_PROCESSED_IMAGES])
+        if height % grid or width % grid:
+            cells = np.array([np.asarray(Image.fromarray(tile).resize((grid, grid), Image.BOX)) for tile in block])
+        else:
+            cells = block.reshape(len(block), grid, height // grid, grid, width // grid, 3).mean(axis=(2, 4))
+        descriptors[start:start + len(block)] = cells.reshape(len(block), -1)
+    return descriptors
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
     with open(filename, 'rb') as file:
-        return pickle.load(file)
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 
-is_first_print = True
-last_percent = None
-last_percent_time_left = None
-last_percent_print_time = None
-est_time_lefts = [0, 0, 0]
-
-
-# est time left is very unaccurate
-def print_progress(curr, total, curr_chunk=None, total_chunks=None):
-    global is_first_print
-    global last_percent
-    global last_percent_time_left
-    global last_percent_print_time
-    global est_time_lefts
-    curr_percent = math.floor(curr / total * 100)
-    curr_time = time.time()
-    if is_first_print:
-        est_time_left = float("inf")
-        is_first_print = False
-        last_percent_time_left = est_time_left
-        last_percent_print_time = curr_time
-    elif last_percent == curr_percent:
-        est_time_left = last_percent_time_left
-    else:
-        bad_est_time_left = (curr_time - last_percent_print_time) / (curr_percent - last_percent) * (100 - curr_percent)
-        est_time_lefts.append(bad_est_time_left)
-        est_time_lefts = est_time_lefts[1:]
-        est_time_left = sum(est_time_lefts) / len(est_time_lefts)
-        last_percent_time_left = est_time_left
-        last_percent_print_time = curr_time
-
-    last_percent = curr_percent
-
-    print('\r >>> {0} / {1} => {2}% | Time Left est. {3:.2f}s'.format(curr, total, curr_percent, est_time_left), end='')
-
-    if curr_chunk and total_chunks:
-        print(' | {} / {}'.format(curr_chunk, total_chunks), end='')
+class ReadDecodePipeline(object):
+    """
+    reads files in reader threads and decodes them in worker threads, queues between the stages are bounded so
+    at most queue_size files are held at a time, PIL releases the GIL while decoding and resizing
+
+    Variables:
+        self.files
+        self.decode  # function of (filename, bytes of the file), run in worker threads
+        self.readers  # number of reader threads
+        self.workers  # number of decode threads
+        self.queue_size
+    """
+
+    def __init__(self, files, decode, readers, workers, queue_size):
+        self.files = list(files)
+        self.decode = decode
+        self.readers = max(1, readers)
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._stop = Event()
+
+    def _put(self, target, item):
+        # give up when the consumer stopped, instead of blocking forever on a full queue
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _read(self, indices, read_queue, recorder):
+        while not self._stop.is_set():
+            try:
+                index = indices.get_nowait()
+            except Empty:
+                return
+            start_time = time.perf_counter()
+            try:
+                with open(self.files[index], 'rb') as file:
+                    data = file.read()
+            except Exception as e:
+                self._put(read_queue, (index, None, e))
+                continue
+            recorder.add('read', time.perf_counter() - start_time, 1)
+            self._put(read_queue, (index, data, None))
+
+    def _close_reads(self, readers, read_queue):
+        for reader in readers:
+            reader.join()
+        for _ in range(self.workers):
+            self._put(read_queue, None)
+
+    def _work(self, read_queue, result_queue):
+        while not self._stop.is_set():
+            try:
+                item = read_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is None:
+                self._put(result_queue, None)
+                return
+            index, data, error = item
+            if error is None:
+                try:
+                    result = self.decode(self.files[index], data)
+                except Exception as e:
+                    error = e
+            self._put(result_queue, (index, None if error else result, error))
+
+    def __iter__(self):
+        """
+        :return: iterator of (index into files, result of decode), in order of completion
+        """
+        indices = Queue()
+        for index in range(len(self.files)):
+            indices.put(index)
+        read_queue = Queue(self.queue_size)
+        result_queue = Queue(self.queue_size)
+        recorder = metrics.current()
+        readers = [Thread(target=self._read, args=(indices, read_queue, recorder), daemon=True)
+                   for _ in range(self.readers)]
+        threads = readers + [Thread(target=self._close_reads, args=(readers, read_queue), daemon=True)]
+        threads += [Thread(target=self._work, args=(read_queue, result_queue), daemon=True)
+                    for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            finished = 0
+            while finished < self.workers:
+                item = result_queue.get()
+                if item is None:
+                    finished += 1
+                    continue
+                index, result, error = item
+                if error is not None:
+                    # decode reads from memory, so errors do not name the file
+                    raise ValueError('Cannot read {}: {}'.format(self.files[index], error)) from error
+                yield index, result
+        finally:
+            self._stop.set()
+
+
+class PNGWriter(object):
+    """
+    writes an RGB png a few rows at a time, so the whole image is never in memory
+
+    Variables:
+        self.file
+        self.width
+        self.height
+        self.rows_written
+    """
+
+    def __init__(self, filename, width, height):
+        self.file = open(filename, 'wb')
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(settings.PNG_COMPRESS_LEVEL)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    def write(self, rows):
+        """
+        :param rows: (N, width, 3) uint8 array, the next N rows of the image
+        """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, 3) or self.rows_written + len(rows) > self.height:
+            raise ValueError('Rows of shape {} do not fit in {}x{} png with {} rows written'.format(
+                rows.shape, self.width, self.height, self.rows_written))
+        # 'sub' filter, each byte minus the same channel of the pixel on its left, compresses better than raw
+        lines = rows.reshape(len(rows), -1)
+        filtered = np.empty((len(rows), lines.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = lines[:, :3]
+        filtered[:, 4:] = lines[:, 3:] - lines[:, :-3]
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError('Only {} of {} rows written to {}'.format(self.rows_written, self.height, self.file.name))
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self.file.close()
+
+
+def save_array(filename, array):
+    """
+    np.save to a file of this thread first then rename it, so other processes or threads never load a half written file
+    """
+    temporary = '{}.{}.{}.tmp'.format(filename, os.getpid(), get_ident())
+    with open(temporary, 'wb') as file:
+        np.save(file, array)
+    os.replace(temporary, filename)
+
+
+def load(filename):
+    with open(filename, 'rb') as file:
+        return pickle.load(file)
 
 
 def print_done(msg):
@@ -120,40 +717,3 @@ def print_done(msg):
         print(' [ done ] => {msg}s'.format(msg=msg))
     else:  # a float, time taken
         print(' [ done ] => {0:.2f}s'.format(msg))
-    global is_first_print
-    global last_percent
-    global last_percent_time_left
-    global last_percent_print_time
-    global est_time_lefts
-    is_first_print = True
-    last_percent = None
-    last_percent_print_time = None
-    last_percent_time_left = None
-    est_time_lefts = [0, 0, 0]
-
-
-# def remove_empty(a_list):
-#     if not isinstance(a_list, list):
-#         return a_list
-#
-#     if not a_list:
-#         return False
-#
-#     result = []
-#     for item in a_list:
-#         item = remove_empty(item)
-#         if item:
-#             result.append(item)
-#     return result
-
-
-def remove_empty(a_list):
-    if not isinstance(a_list, list):
-        return a_list
-    result = []
-    for item in a_list:
-        if item:
-            item = remove_empty(item)
-            if item:
-                result.append(item)
-    return result
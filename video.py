@@ -0,0 +1,168 @@
+import argparse
+import os
+import sys
+import time
+from glob import glob
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import main
+import metrics
+import settings
+import utilities
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+
+def read_frames(path):
+    """
+    :param path: folder of frame images, in order of their filenames, or an animated image such as gif
+    :return: iterator of (RGB frame, duration in ms or None)
+    """
+    if os.path.isdir(path):
+        for filename in sorted(glob(path + '/*[jpg|png]')):
+            yield Image.open(filename).convert('RGB'), None
+    else:
+        with Image.open(path) as image:
+            for frame in ImageSequence.Iterator(image):
+                yield frame.convert('RGB'), frame.info.get('duration')
+
+
+class FrameMosaic(object):
+    """
+    makes mosaics of consecutive frames, chunks that barely changed since they were last matched keep their tile
+
+    Variables:
+        self.database  # loaded ImageDatabase
+        self.size
+        self.use_repeat
+        self.method
+        self.threshold  # see VIDEO_CHANGE_THRESHOLD
+        self.repeat_view  # processed view of database shared by all frames when repeat is allowed
+        self.reference  # (rows, cols, 3) average colors of the chunks when they were last matched
+        self.indices  # (rows * cols,) tile ids of the chunks
+        self.mosaic  # (rows * height, cols * width, 3) uint8 array of the last frame
+    """
+
+    def __init__(self, database, size, use_repeat, method=None, threshold=None):
+        self.database = database
+        self.size = size
+        self.use_repeat = use_repeat
+        self.method = method or settings.COLOR_DIFF_METHOD
+        self.threshold = settings.VIDEO_CHANGE_THRESHOLD if threshold is None else threshold
+        self.repeat_view = None
+        self.reference = None
+        self.indices = None
+        self.mosaic = None
+
+    def make(self, source):
+        """
+        :param source: frame, resized already, all frames must be the same size
+        :return: the mosaic of the frame, same size as source
+        """
+        width, height = source.size
+        if self.use_repeat:
+            # finding with repeat changes no matching state, so the view is processed once for all frames
+            if self.repeat_view is None:
+                self.repeat_view = self.database.view()
+            database = self.repeat_view
+        else:
+            database = self.database.view()
+        with metrics.stage('source feature'):
+            grid = database.describe(source, self.size)
+        rows, cols = grid.shape[:2]
+        features = grid.reshape(rows * cols, -1)
+
+        # tiles cannot be reserved when streaming features from disk, so without repeat every chunk is matched again
+        full = self.reference is None or self.reference.shape != grid.shape or \
+            (not self.use_repeat and database.streaming)
+        if full:
+            changed = np.arange(len(features))
+        else:
+            changed = np.flatnonzero(np.abs(grid - self.reference).max(axis=2).ravel() > self.threshold)
+        metrics.count('chunks matched', len(changed))
+        metrics.count('chunks reused', len(features) - len(changed))
+
+        if len(changed) == len(features):
+            self.indices = database.find_closest_batch(features, self.use_repeat, method=self.method)
+            self.mosaic = database.composite(self.indices, rows, cols)
+        elif len(changed):
+            if not self.use_repeat:
+                kept = np.ones(len(features), dtype=bool)
+                kept[changed] = False
+                database.reserve(self.indices[kept])
+            self.indices[changed] = database.find_closest_batch(features[changed], self.use_repeat,
+                                                                method=self.method)
+            with metrics.stage('paste', len(changed)):
+                cells = self.mosaic.reshape(rows, self.database.height, cols, self.database.width, 3)
+                changed_rows, changed_cols = np.divmod(changed, cols)
+                cells[changed_rows, :, changed_cols] = database.get_tile_arrays(self.indices[changed])
+
+        if full:
+            self.reference = grid.copy()
+        else:
+            self.reference.reshape(rows * cols, -1)[changed] = features[changed]
+        return Image.fromarray(self.mosaic[:height, :width])
+
+
+def main_video():
+    parser = argparse.ArgumentParser(description='build mosaics of the frames of a video from images')
+    parser.add_argument('-src', '--source', help='folder of frames, in order of filenames, or an animated gif')
+    parser.add_argument('-s', '--size', type=int, help='the size of each pieces')
+    parser.add_argument('-f', '--folder', help='the folder containing images used to stimulate the frames')
+    parser.add_argument('-d', '--dest', help='the folder to save mosaic frames in')
+    parser.add_argument('-r', '--repeat', action='store_true', help='allow build with repeating images')
+    parser.add_argument('-fa', '--factor', type=float, default=1, help='result size factor compared to original')
+    parser.add_argument('-b', '--blend', type=float, default=1.0,
+                        help='blend level of the mosaic over each frame, between 0 and 1, default 1')
+    parser.add_argument('-t', '--threshold', type=int, help='see VIDEO_CHANGE_THRESHOLD')
+    parser.add_argument('-fmt', '--format', default='png', help='extension of output frames, default png')
+    parser.add_argument('-m', '--metrics', help='save time spent in each stage as json to this file')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dest):
+        os.makedirs(args.dest)
+    method = settings.COLOR_DIFF_METHOD
+    database = None
+    frame_mosaic = None
+    outputs = []
+    durations = []
+    start_time = time.time()
+    for index, (frame, duration) in enumerate(read_frames(args.source)):
+        frame_start_time = time.time()
+        if database is None:
+            width, height, pieces_required = main.get_dimension(frame, args.size, args.factor, args.repeat, method)
+            database = main._load_database(args.folder, args.size, args.repeat, pieces_required)
+            frame_mosaic = FrameMosaic(database, args.size, args.repeat, method, args.threshold)
+        frame = frame.resize((width, height))
+        matched_before = metrics.current().counters.get('chunks matched', 0)
+        mosaic = frame_mosaic.make(frame)
+        if args.blend < 1:
+            mosaic = Image.blend(frame, mosaic, args.blend)
+        filename = os.path.join(args.dest, 'frame_{:05d}.{}'.format(index, args.format))
+        with metrics.stage('encode', 1):
+            mosaic.save(filename)
+        outputs.append(filename)
+        durations.append(duration)
+        print('frame {} | matched {} / {} chunks [ done ] => {:.2f}s'.format(
+            index, metrics.current().counters['chunks matched'] - matched_before, pieces_required,
+            time.time() - frame_start_time))
+
+    if outputs and all(durations):
+        # animated source, also save the frames as one gif
+        filename = os.path.join(args.dest, 'mosaic.gif')
+        frames = [Image.open(output) for output in outputs]
+        frames[0].save(filename, save_all=True, append_images=frames[1:], duration=durations, loop=0)
+        print('Saved {}'.format(filename))
+    utilities.print_done(time.time() - start_time)
+
+    print('=' * 50)
+    metrics.current().print_summary()
+    if args.metrics:
+        metrics.current().save(args.metrics)
+        print('Metrics saved to {}'.format(args.metrics))
+
+
+if __name__ == '__main__':
+    main_video()